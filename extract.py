@@ -8,33 +8,75 @@
 
    The actual extraction is done by format-specific modules.
    Run `./extractor.py --help` for options.
+
+   Use `--workers N` to extract from N files at a time, in
+   separate processes.
+
+   With `settings.extraction_timeout` or `settings.extraction_max_rss`
+   set, each file is extracted in a child process of its own, that is
+   killed if it overruns. Such files, and files with more pages to OCR
+   than `settings.extraction_max_ocr_pages`, are put in the quarantine
+   list (see modules/quarantine.py), and skipped by later runs.
 """
 
 import settings
 
-from os import path
+from collections import Counter
+from multiprocessing import Process
+from multiprocessing.pool import Pool
+from threading import Lock
 
 from modules.interface import Interface
 from modules.databases.debuggerdb import DebuggerDB
-from modules.documents import DocumentList, document_headers
+from modules.documents import DocumentList, document_headers, should_store
+from modules.tempspace import TempSpace, purge_stale
+from modules.protokollen import ExtractedSnapshot
+from modules.cache import get_extraction_cache
+from modules.watchdog import run_with_budget, BudgetExceeded, ChildFailed
+from modules.quarantine import get_quarantine
+from modules import sidecar
 from modules.extractors.documentBase import ExtractionNotAllowed
 from modules.extractors.documentBase import CompatibilityError
+from modules.extractors.documentBase import ExtractionBudgetExceeded
 
+EXTRACTED = "extracted"
+SKIPPED = "skipped"
+FAILED = "failed"
+QUARANTINED = "quarantined"
+"""Possible outcomes of extract_file"""
 
-def main():
-    """Entry point when run from command line"""
+BATCH_SIZE = 100
+"""Number of files to check for existing data in one go"""
 
-    command_line_args = ["overwrite", {
-        "short": "-f",
-        "long": "--from",
-        "dest": "start_from",
-        "type": str,
-        "help": "What file to start extracting from."
-    }]
-    ui = Interface(__file__,
-                   "Extracts text and metadata from files",
-                   commandline_args=command_line_args)
 
+class _NonDaemonicProcess(Process):
+    """A process that can start processes of its own"""
+
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class WorkerPool(Pool):
+    """A Pool whose workers can start processes of their own, e.g. for
+       page range extraction of large PDF files (see
+       `settings.pdf_range_processes`). Workers are not daemonic, so the
+       pool must be closed or terminated before exiting.
+    """
+    Process = _NonDaemonicProcess
+
+
+def connect(ui):
+    """Set up storage and database connections, and return them as a
+       tuple: (files_connection, docs_connection, files_db, docs_db)
+
+       Connections are not shared between processes, so each worker
+       will call this to get its own.
+    """
     ui.info("Connecting to storage")
     files_connection = settings.Storage(settings.access_key_id,
                                         settings.secret_access_key,
@@ -62,134 +104,462 @@ def main():
         files_db = None
         docs_db = DebuggerDB(None, settings.db_extactor_table or "TABLE")
 
-    keep_waiting = (ui.args.start_from is not None)
+    # Collect all attributes of a document, and write them in one go
+    docs_db = docs_db.buffered()
 
-    for key in files_connection.get_next_file():
+    return (files_connection, docs_connection, files_db, docs_db)
 
-        # Are we waiting for a certain key before starting?
-        if keep_waiting is True:
-            if key.name == ui.args.start_from.decode("utf8"):
-                keep_waiting = False
-            else:
-                continue
 
-        # first of all, check if the processed file already exists in
-        # remote storage (no need to do expensive PDF processing if it
-        # is.
-        prefix = docs_connection.buildRemoteName(key.basename,
-                                                 path=key.path_fragments)
-        """ "Ale kommun/xxx" """
-        ui.debug("file prefix: %s" % prefix)
+def check_keys(keys, ui, connections, snapshot=None):
+    """Check a batch of storage keys for existing data, with one request
+       each to the files db, the docs storage and the docs db for the
+       whole batch.
+       If an ExtractedSnapshot is given, it is used instead of the docs
+       storage and docs db.
+       Yields a tuple (key, reason) for each key, where reason is None
+       for files that should be extracted, or why they should be skipped.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
 
-        files_dbkey = files_db.create_key(key.path_fragments + [key.filename])
-        """ "Ale kommun-xxx.pdf" """
-        ui.debug("files_dbkey: %s" % files_dbkey)
+    prefixes = [docs_connection.buildRemoteName(key.basename,
+                                                path=key.path_fragments)
+                for key in keys]
+    """ "Ale kommun/xxx" """
+    files_dbkeys = [files_db.create_key(key.path_fragments + [key.filename])
+                    for key in keys]
+    """ "Ale kommun-xxx.pdf" """
 
-        if not files_db.exists(files_dbkey):
-            ui.warning("File db data missing for file %s" % key)
-            continue
+    existing_files = files_db.exists_many(files_dbkeys)
+
+    # check if the processed file already exists in remote storage
+    # (no need to do expensive PDF processing if it is.
+    def is_extracted(prefix, files_dbkey):
+        if ui.args.overwrite:
+            return False
+        if snapshot is not None:
+            return snapshot.is_extracted(files_dbkey, prefix)
+        return (prefix in extracted_prefixes and
+                doc_counts.get(files_dbkey))
+
+    extracted_prefixes = set()
+    doc_counts = {}
+    if not ui.args.overwrite and snapshot is None:
+        extracted_prefixes = docs_connection.prefixes_exist(prefixes)
+        # One request for all files with extracted documents in storage
+        doc_counts = docs_db.count_attribute_with_values(
+            "file_key",
+            [files_dbkey for (prefix, files_dbkey)
+             in zip(prefixes, files_dbkeys)
+             if prefix in extracted_prefixes])
 
-        existing_docs_data = docs_db.get_attribute_with_value("file_key",
-                                                              files_dbkey)
-        if (docs_connection.prefix_exists(prefix) and
-                existing_docs_data is not None and
-                not ui.args.overwrite):
+    for (key, prefix, files_dbkey) in zip(keys, prefixes, files_dbkeys):
+        ui.debug("file prefix: %s, files_dbkey: %s" % (prefix, files_dbkey))
+        if files_dbkey not in existing_files:
+            ui.warning("File db data missing for file %s" % key)
+            yield (key, "File db data missing")
+        elif is_extracted(prefix, files_dbkey):
             ui.debug("Documents already extracted for file %s (%s)" %
                      (prefix, files_dbkey))
-            continue
+            yield (key, "Documents already extracted")
+        else:
+            yield (key, None)
+
 
-        downloaded_file = None
+def extract_file(key, ui, connections):
+    """Extract documents from the file identified by the storage key `key`,
+       and store them. Returns a tuple (outcome, message), where outcome is
+       one of EXTRACTED, SKIPPED, FAILED or QUARANTINED.
+
+       Use check_keys first, to skip files already extracted.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+
+    # The download, and everything the extractor writes, goes in a
+    # private temp space. The same file might be harvested for more than
+    # one municipality, and then have the same name in both.
+    with TempSpace() as temp_space:
         ui.info("Fetching file %s" % key.name)
         try:
-            temp_filename = path.join("temp", key.filename)
+            temp_filename = temp_space.get_path(key.filename)
             downloaded_file = files_connection.get_file(key,
                                                         temp_filename)
         except Exception as e:
             ui.warning("Could not fetch %s from storage: %s: %s" %
                        (key.name, type(e), e))
-            continue
+            return (FAILED, "Could not fetch from storage: %s" % e)
 
         file_type = downloaded_file.get_file_type()
         if file_type not in settings.allowedFiletypes:
-            ui.warning("Filetype %s is not allowed in settings.py" % file_type)
-            continue
-
-        extractor = downloaded_file.extractor()
-        extractor_type = type(extractor).__name__
-        if extractor_type == "HtmlExtractor":
-            harvesting_rules = files_db.get(files_dbkey, "harvesting_rules")
-            extractor.content_xpath = harvesting_rules["html"]
-            ui.debug("HTML file. Content is in %s" % extractor.content_xpath)
+            ui.warning("Filetype %s is not allowed in settings.py" %
+                       file_type)
+            return (SKIPPED, "Filetype %s is not allowed" % file_type)
 
-        ui.info("Extracting from %s with %s" % (downloaded_file.localFile,
-                                                extractor_type))
+        extractor = downloaded_file.extractor(temp_space=temp_space,
+                                              cache=get_extraction_cache())
         try:
-            document_list = DocumentList(extractor)
-        except ExtractionNotAllowed:
-            ui.warning("Exraction not allowed for %s" % key.name)
-            # Continue without deleting. We might want to inspect this file
+            return _extract_documents(key, extractor, ui, connections)
+        finally:
+            extractor.close()
+
+
+def get_document_names(key, i, connections):
+    """Return a tuple (docs_dbkey, remote_filename) for document number
+       `i` from the file `key`.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+    remote_filename = docs_connection.buildRemoteName(
+        str(i),
+        ext="txt",
+        path=key.path_fragments + [key.filename])
+    """ "Ale kommun/xxx/1.txt" """
+    docs_dbkey = docs_db.create_key([key.path, key.filename, str(i)])
+    """ "Ale kommun-xxx-1" """
+    return (docs_dbkey, remote_filename)
+
+
+def store_document(key, i, document, file_data, connections,
+                   overwrite=False):
+    """Store document number `i` from the file `key`, in the documents
+       database and storage. `file_data` holds the `origin` and
+       `municipality` of the file, from the files database.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+    files_dbkey = files_db.create_key(key.path_fragments + [key.filename])
+    (docs_dbkey, remote_filename) = get_document_names(key, i, connections)
+
+    values = [
+        ("meeting_date", document.date),
+        ("file_key", files_dbkey),
+        ("file", key.name),
+        ("header", document.header),
+        ("text_file", remote_filename),
+        ("text", document.text),
+        ("document_type", document.type_),
+        # Original URL, if any
+        ("source", file_data[u"origin"]),
+        # NB We use a different, but more logical naming scheme for docs
+        ("origin", file_data[u"municipality"]),
+    ]
+    for (attr, value) in values:
+        docs_db.put(docs_dbkey, attr, value, overwrite=overwrite)
+
+    docs_connection.put_file_from_string(document.text,
+                                         remote_filename,
+                                         headers=document_headers)
+
+
+def _store_documents(key, files_dbkey, document_list, ui, connections):
+    """Store the documents in `document_list` that should be stored.
+       Returns the number of documents, and the set of the numbers of
+       the stored ones.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+    # Fetched once, as they are stored with each document
+    file_data = files_db.get_many(files_dbkey, [u"origin", u"municipality"])
+
+    # Start OCR of the pages to be stored, if done in the background
+    for document in document_list.get_next_document():
+        if should_store(document):
+            document.prefetch_text()
+
+    i = 0
+    stored = set()
+    # FIXME: let DocumentList keep track of this
+    for document in document_list.get_next_document():
+        i += 1
+        if not should_store(document):
+            # Do not even fetch the text, as that might mean OCR
+            ui.info("Skipping document of type %s" % document.type_)
             continue
-        except CompatibilityError:
-            ui.warning("Could not understand the file %s" % key.name)
-            # Continue without deleting. We might want to inspect this file
+        if ui.executionMode >= Interface.DRY_MODE:
+            (docs_dbkey, remote_filename) = get_document_names(key, i,
+                                                               connections)
+            print "docs_dbkey"
+            print docs_dbkey
+            print "document_type",
+            print document.type_
+            print "meeting_date",
+            print document.date
+            print "source",
+            print file_data[u"origin"]
+            print "origin",
+            print file_data[u"municipality"]
+            print "text_file",
+            print remote_filename
+            print "original file",
+            print files_dbkey
+            print "text length",
+            print len(document.text)
             continue
-        except OSError:
-            ui.error("OS error (probably out of memory)\
-                      when extracting from %s: " % key.name)
+        if (len(document.text) == 0) or document.text.isspace():
+            ui.info("Skipping empty document")
             continue
+        store_document(key, i, document, file_data, connections)
+        stored.add(i)
+    return (i, stored)
 
-        i = 0
-        # FIXME: let DocumentList keep track of this
-        for document in document_list.get_next_document():
-            i += 1
-            remote_filename = docs_connection.buildRemoteName(
-                str(i),
-                ext="txt",
-                path=key.path_fragments + [key.filename])
-            """ "Ale kommun/xxx/1.txt" """
-            docs_dbkey = docs_db.create_key([key.path, key.filename, str(i)])
-
-            if ui.executionMode >= Interface.DRY_MODE:
-                print "docs_dbkey"
-                print docs_dbkey
-                print "document_type",
-                print document.type_
-                print "meeting_date",
-                print document.date
-                print "source",
-                print files_db.get(files_dbkey, u"origin")
-                print "origin",
-                print files_db.get(files_dbkey, u"municipality")
-                print "text_file",
-                print remote_filename
-                print "original file",
-                print files_dbkey
-                print "text length",
-                print len(document.text)
-                continue
-            if (len(document.text) == 0) or document.text.isspace():
-                ui.info("Skipping empty document")
+
+def _extract_documents(key, extractor, ui, connections):
+    """Split a file into documents, using `extractor`, and store them.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+    files_dbkey = files_db.create_key(key.path_fragments + [key.filename])
+
+    extractor_type = type(extractor).__name__
+    if extractor_type == "HtmlExtractor":
+        harvesting_rules = files_db.get(files_dbkey, "harvesting_rules")
+        extractor.content_xpath = harvesting_rules["html"]
+        ui.debug("HTML file. Content is in %s" % extractor.content_xpath)
+
+    ui.info("Extracting from %s with %s" % (extractor.path,
+                                            extractor_type))
+    # Pages are parsed, and text OCR:ed, lazily, so storing documents
+    # can fail in the same ways as splitting the file
+    try:
+        document_list = DocumentList(extractor)
+        (i, stored) = _store_documents(key, files_dbkey, document_list,
+                                       ui, connections)
+    except ExtractionNotAllowed:
+        ui.warning("Exraction not allowed for %s" % key.name)
+        return (FAILED, "Extraction not allowed")
+    except CompatibilityError:
+        ui.warning("Could not understand the file %s" % key.name)
+        return (FAILED, "Could not understand the file")
+    except OSError:
+        ui.error("OS error (probably out of memory)\
+                  when extracting from %s: " % key.name)
+        return (FAILED, "OS error (probably out of memory)")
+    except ExtractionBudgetExceeded as e:
+        ui.warning("Giving up on %s: %s" % (key.name, e))
+        return (QUARANTINED, str(e))
+
+    ocr_resolutions = Counter(page.ocr_resolution
+                              for (page, header, date) in document_list.pages
+                              if page.ocr_resolution is not None)
+    if ocr_resolutions:
+        ui.info("Pages OCR:ed at each resolution: %s" %
+                ", ".join("%d dpi: %d" % (resolution, count)
+                          for (resolution, count)
+                          in sorted(ocr_resolutions.items())))
+
+    if ui.executionMode < Interface.DRY_MODE:
+        # Keep pages and grouping, for reclassify.py
+        docs_connection.put_file_from_string(
+            sidecar.dumps(sidecar.build_sidecar(key, files_dbkey,
+                                                document_list, stored)),
+            sidecar.get_sidecar_name(docs_connection,
+                                     key.path_fragments, key.filename))
+
+    return (EXTRACTED, "%d documents" % i)
+
+
+def _extract_in_child(key_name, ui):
+    """Extract from a file in a child process, with connections of its
+       own, as the child might be killed in the middle of a request.
+    """
+    connections = connect(ui)
+    try:
+        key = connections[0].get_key(key_name)
+        return extract_file(key, ui, connections)
+    finally:
+        # Flush the documents db buffer
+        connections[3].close()
+
+
+def extract_file_with_budget(key, ui, connections):
+    """Like extract_file, but in a child process, that is killed if it
+       runs for longer than `settings.extraction_timeout` seconds, or
+       uses more than `settings.extraction_max_rss` bytes of memory.
+       Without either setting, the file is extracted in this process.
+
+       Files that overrun are added to the quarantine list.
+    """
+    timeout = getattr(settings, "extraction_timeout", None)
+    max_rss = getattr(settings, "extraction_max_rss", None)
+    if timeout is None and max_rss is None:
+        (outcome, message) = extract_file(key, ui, connections)
+    else:
+        try:
+            (outcome, message) = run_with_budget(_extract_in_child,
+                                                 (key.name, ui),
+                                                 timeout=timeout,
+                                                 max_rss=max_rss)
+        except BudgetExceeded as e:
+            ui.warning("Gave up on %s: %s" % (key.name, e))
+            (outcome, message) = (QUARANTINED, str(e))
+        except ChildFailed as e:
+            ui.error("Failed to extract from %s: %s" % (key.name, e))
+            (outcome, message) = (FAILED, str(e))
+    if outcome == QUARANTINED:
+        get_quarantine().add(key.name, message)
+    return (outcome, message)
+
+
+_worker_ui = None
+_worker_connections = None
+"""Per process state, set up by _init_worker"""
+
+
+def _init_worker(ui):
+    """Runs once in each worker process, to give it connections of its own.
+    """
+    import signal
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    global _worker_ui, _worker_connections
+    _worker_ui = ui
+    _worker_connections = connect(ui)
+
+    # atexit handlers are not run in pool workers, so make sure
+    # the documents db buffer is flushed when the worker exits
+    from multiprocessing.util import Finalize
+    docs_db = _worker_connections[3]
+    Finalize(None, docs_db.close, exitpriority=10)
+
+
+def _extract_in_worker(key_name):
+    """Extract from a file in a worker process. Keys are passed by name, as
+       storage keys can not be reliably pickled.
+       Returns a tuple (key_name, outcome, message)
+    """
+    files_connection = _worker_connections[0]
+    try:
+        key = files_connection.get_key(key_name)
+        (outcome, message) = extract_file_with_budget(key,
+                                                      _worker_ui,
+                                                      _worker_connections)
+    except Exception as e:
+        # Report, rather than let one file bring down the whole pool
+        _worker_ui.error("Failed to extract from %s: %s: %s" %
+                         (key_name, type(e), e))
+        (outcome, message) = (FAILED, "%s: %s" % (type(e), e))
+    return (key_name, outcome, message)
+
+
+def main():
+    """Entry point when run from command line"""
+
+    command_line_args = ["overwrite", {
+        "short": "-f",
+        "long": "--from",
+        "dest": "start_from",
+        "type": str,
+        "help": "What file to start extracting from."
+    }, {
+        "short": "-w",
+        "long": "--workers",
+        "dest": "workers",
+        "type": int,
+        "default": 1,
+        "help": "Number of files to extract from in parallel."
+    }, {
+        "short": "-n",
+        "long": "--no-prescan",
+        "dest": "no_prescan",
+        "action": "store_true",
+        "help": """Check for already extracted documents batch by batch,
+                   rather than listing all of them at startup.
+                   Faster for short runs."""
+    }]
+    ui = Interface(__file__,
+                   "Extracts text and metadata from files",
+                   commandline_args=command_line_args)
+
+    removed = purge_stale()
+    if removed:
+        ui.info("Removed %d temp spaces left by dead processes" % removed)
+
+    connections = connect(ui)
+    (files_connection, docs_connection, files_db, docs_db) = connections
+
+    snapshot = None
+    if not (ui.args.overwrite or ui.args.no_prescan):
+        ui.info("Listing already extracted documents")
+        snapshot = ExtractedSnapshot(docs_db, docs_connection)
+        ui.info("Documents found for %d files" % len(snapshot))
+
+    quarantine = get_quarantine()
+
+    def get_next_key():
+        """Yield storage keys, starting from `--from`, if given."""
+        keep_waiting = (ui.args.start_from is not None)
+        for key in files_connection.get_next_file():
+            # Are we waiting for a certain key before starting?
+            if keep_waiting is True:
+                if key.name == ui.args.start_from.decode("utf8"):
+                    keep_waiting = False
+                else:
+                    continue
+            if key.name in quarantine:
+                ui.debug("Skipping quarantined file %s" % key.name)
+                count_outcome(SKIPPED)
                 continue
-            """ "Ale kommun-xxx-1" """
-            docs_db.put(docs_dbkey, "meeting_date", document.date)
-            docs_db.put(docs_dbkey, "file_key", files_dbkey)
-            docs_db.put(docs_dbkey, "file", key.name)
-            docs_db.put(docs_dbkey, "header", document.header)
-            docs_db.put(docs_dbkey, "text_file", remote_filename)
-            docs_db.put(docs_dbkey, "text", document.text)
-            docs_db.put(docs_dbkey, "document_type", document.type_)
-            # Original URL, if any
-            docs_db.put(docs_dbkey, "source",
-                        files_db.get(files_dbkey, u"origin"))
-            # NB We use a different, but more logical naming scheme for docs
-            docs_db.put(docs_dbkey, "origin",
-                        files_db.get(files_dbkey, u"municipality"))
-
-            docs_connection.put_file_from_string(document.text,
-                                                 remote_filename,
-                                                 headers=document_headers)
-
-        downloaded_file.delete()
+            yield key
+
+    outcomes = {EXTRACTED: 0, SKIPPED: 0, FAILED: 0, QUARANTINED: 0}
+    outcomes_lock = Lock()
+    failures = []
+
+    def count_outcome(outcome):
+        """Keys are listed in the pool's task handler thread, while
+           results are counted in this one.
+        """
+        with outcomes_lock:
+            outcomes[outcome] += 1
+
+    def get_next_batch():
+        """Yield lists of BATCH_SIZE storage keys."""
+        batch = []
+        for key in get_next_key():
+            batch.append(key)
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def get_keys_to_extract():
+        """Yield storage keys for files that need extracting."""
+        for batch in get_next_batch():
+            for (key, reason) in check_keys(batch, ui, connections,
+                                            snapshot=snapshot):
+                if reason is None:
+                    yield key
+                else:
+                    count_outcome(SKIPPED)
+
+    if ui.args.workers > 1:
+        ui.info("Extracting with %d worker processes" % ui.args.workers)
+        pool = WorkerPool(processes=ui.args.workers,
+                          initializer=_init_worker,
+                          initargs=(ui,))
+        key_names = (key.name for key in get_keys_to_extract())
+        try:
+            for (key_name, outcome, message) in pool.imap_unordered(
+                    _extract_in_worker, key_names):
+                count_outcome(outcome)
+                if outcome == FAILED:
+                    failures.append((key_name, message))
+            pool.close()
+        except KeyboardInterrupt:
+            ui.info("Interrupted, stopping workers")
+            pool.terminate()
+        pool.join()
+    else:
+        for key in get_keys_to_extract():
+            (outcome, message) = extract_file_with_budget(key, ui,
+                                                          connections)
+            count_outcome(outcome)
+            if outcome == FAILED:
+                failures.append((key.name, message))
+
+    ui.info("Done. %d files extracted, %d skipped, %d failed, "
+            "%d quarantined" %
+            (outcomes[EXTRACTED], outcomes[SKIPPED], outcomes[FAILED],
+             outcomes[QUARANTINED]))
+    for (key_name, message) in failures:
+        ui.info("Failed: %s (%s)" % (key_name, message))
 
     ui.exit()
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""Compares OCR of the pages of a local, scanned PDF file with and
+   without image preprocessing (see modules/imageprep.py), to help
+   choosing `settings.ocr_preprocessing`. Prints pixels, time, mean
+   word confidence and text length for each page. Nothing is cached.
+"""
+
+from time import time
+
+from modules.interface import Interface
+from modules.ocr import OcrService
+from modules.imageprep import STEPS, get_steps, preprocess
+from modules.extractors.pdfUtils import PageRenderer
+from modules.extractors.documentBase import CompatibilityError
+
+
+def benchmark(service, image, steps):
+    """Return (pixels, seconds, confidence, text length) for preprocessing
+       `image` with `steps`, and OCR:ing it.
+    """
+    start = time()
+    image = preprocess(image, steps)
+    (text, confidence) = service.image_to_string_with_confidence(image)
+    seconds = time() - start
+    (width, height) = image.size
+    return (width * height, seconds, confidence, len(text))
+
+
+def main():
+    """Entry point when run from command line"""
+
+    commandline_args = [{
+        "short": "-f", "long": "--file",
+        "type": str, "dest": "file",
+        "help": "PDF file to OCR."
+    }, {
+        "short": "-p", "long": "--pages",
+        "type": int, "dest": "pages", "default": 5,
+        "help": "Number of pages to OCR."
+    }, {
+        "short": "-r", "long": "--resolution",
+        "type": int, "dest": "resolution", "default": 300,
+        "help": "Resolution to render pages at, in dpi."
+    }, {
+        "short": "-s", "long": "--steps",
+        "type": str, "dest": "steps", "default": None,
+        "help": "Comma separated preprocessing steps (%s). Defaults to "
+                "settings.ocr_preprocessing." % ", ".join(STEPS)
+    }]
+    ui = Interface(__file__,
+                   "Benchmarks OCR preprocessing on a local PDF file",
+                   commandline_args=commandline_args)
+
+    if ui.args.steps is not None:
+        steps = [step for step in STEPS if step in ui.args.steps.split(",")]
+    else:
+        steps = get_steps()
+    if not steps:
+        ui.error("No preprocessing steps given, or numpy is not installed")
+        ui.exit()
+    ui.info("Preprocessing steps: %s" % ", ".join(steps))
+
+    service = OcrService()
+    runs = [("original", []), ("prepared", steps)]
+    totals = dict((name, [0, 0.0]) for (name, run_steps) in runs)
+    renderer = PageRenderer(ui.args.file, 1, ui.args.pages,
+                            resolution=ui.args.resolution)
+    try:
+        for page_number in range(1, ui.args.pages + 1):
+            try:
+                image = renderer.get_image(page_number)
+            except CompatibilityError:
+                # No more pages
+                break
+            for (name, run_steps) in runs:
+                (pixels, seconds, confidence, length) = benchmark(service,
+                                                                  image,
+                                                                  run_steps)
+                totals[name][0] += pixels
+                totals[name][1] += seconds
+                print "page %d, %s: %d pixels, %.2f s, confidence %s, " \
+                      "%d characters" % (page_number, name, pixels, seconds,
+                                         confidence, length)
+    finally:
+        renderer.close()
+        service.close()
+
+    for (name, (pixels, seconds)) in sorted(totals.items()):
+        print "total, %s: %d pixels, %.2f s" % (name, pixels, seconds)
+    ui.exit()
+
+if __name__ == '__main__':
+    main()
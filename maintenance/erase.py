@@ -15,6 +15,7 @@ import settings
 from modules.interface import Interface
 from modules.datasheet import CSVFile, GoogleSheet, HeaderlessDataSet
 from modules.databases.debuggerdb import DebuggerDB
+from modules.sidecar import get_sidecar_name
 
 
 def main():
@@ -109,16 +110,16 @@ def main():
             if not ui.ask_if_continue():
                 ui.exit()
 
-        docs_db_ids = docs_db.get_attribute_with_value("file",
-                                                       file_path)
+        num_docs_in_db = docs_db.count_attribute_with_value("file",
+                                                            file_path)
 
         num_docs_in_storage = docs_storage.get_file_list_length(file_path)
-        if num_docs_in_storage != len(docs_db_ids):
+        if num_docs_in_storage != num_docs_in_db:
             ui.warning("Doc count in storage and db do not match")
             if not ui.ask_if_continue():
                 ui.exit()
 
-        if len(docs_db_ids) == 0:
+        if num_docs_in_db == 0:
             ui.info("No documents for %s. Deleting only files" % file_path)
 
         ui.info("Deleting file db entry %s" % db_key)
@@ -129,15 +130,23 @@ def main():
         if ui.executionMode < Interface.DRY_MODE:
             file_storage.delete_file(file_path)
 
-        for docs_db_id in docs_db_ids:
-            doc_file = docs_db.get(docs_db_id, "text_file")
-            ui.info("Deleting document file %s" % doc_file)
-            if ui.executionMode < Interface.DRY_MODE:
-                docs_storage.delete_file(doc_file)
-
-            ui.info("Deleting document db entry %s" % docs_db_id)
-            if ui.executionMode < Interface.DRY_MODE:
-                docs_db.delete(docs_db_id)
+        for docs_db_ids in docs_db.get_next_batch_with_value("file",
+                                                             file_path):
+            for docs_db_id in docs_db_ids:
+                doc_file = docs_db.get(docs_db_id, "text_file")
+                ui.info("Deleting document file %s" % doc_file)
+                if ui.executionMode < Interface.DRY_MODE:
+                    docs_storage.delete_file(doc_file)
+
+                ui.info("Deleting document db entry %s" % docs_db_id)
+                if ui.executionMode < Interface.DRY_MODE:
+                    docs_db.delete(docs_db_id)
+
+        sidecar_name = get_sidecar_name(docs_storage, path_fragments,
+                                        filename)
+        ui.info("Deleting page sidecar %s" % sidecar_name)
+        if ui.executionMode < Interface.DRY_MODE:
+            docs_storage.delete_file(sidecar_name)
 
 if __name__ == '__main__':
     main()
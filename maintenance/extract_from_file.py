@@ -21,6 +21,11 @@ def main():
         "short": "-f", "long": "--file",
         "type": str, "dest": "file",
         "help": "File to extract document(s) from."
+    }, {
+        "short": "-H", "long": "--headers-only",
+        "action": "store_true", "dest": "headers_only",
+        "help": "Classify pages by their headers only, without analysing"
+                " the rest of the pages (PDF files only)."
     }]
     ui = Interface(__file__,
                    "Extracts text and metadata from a local file",
@@ -59,6 +64,10 @@ def main():
 
     extractor = local_file.extractor()
     extractor_type = type(extractor).__name__
+    if ui.args.headers_only and extractor_type == "PdfExtractor":
+        from modules.extractors.pdf import PdfHeaderExtractor
+        extractor.close()
+        extractor = PdfHeaderExtractor(ui.args.file)
     if extractor_type == "HtmlExtractor":
         ui.debug("HTML file. Content is in %s" % extractor.content_xpath)
         extractor.content_xpath = ui.args.html
@@ -77,10 +86,15 @@ def main():
         print document.type_
         print "date",
         print document.date
-        print "len",
-        print len(document)
+        if ui.args.headers_only:
+            print "pages",
+            print document.pages
+        else:
+            print "len",
+            print len(document)
         print document.header
 
+    extractor.close()
     ui.exit()
 
 if __name__ == '__main__':
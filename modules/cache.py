@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""This module contains a simple, size bounded, on-disk cache, shared by
+   all processes on a host. Least recently used entries are evicted
+   when the cache grows beyond its maximum size. The total size is kept
+   in a file in the cache directory, so that processes need not scan
+   the cache to learn it.
+
+   Use `get_extraction_cache` to get the cache for extraction results,
+   and `get_ocr_cache` to get the cache for OCR results, as configured
+   in settings.py.
+"""
+
+import os
+import fcntl
+import tempfile
+import cPickle as pickle
+
+import settings
+
+DEFAULT_SIZE = 2 * 1024 ** 3
+"""Default maximum size, in bytes"""
+
+
+class DiskCache(object):
+    """Stores pickled values in a directory, one file per key.
+       Keys should be hex digests, or other file name safe strings.
+       The modification time of a file is used as its last access time.
+    """
+
+    SUFFIX = ".pickle"
+
+    SIZE_FILE = "size"
+    """Holds the total size of all entries, in bytes. Written with an
+       exclusive lock, as all processes using the cache update it.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key[:2], key + self.SUFFIX)
+
+    def _get_entries(self):
+        """Return a list of (mtime, size, path) for all entries"""
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for f in files:
+                if not f.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # Evicted by someone else
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _lock_size_file(self):
+        """Return the size file, opened and locked. The lock is released
+           when the file is closed.
+        """
+        fd = os.open(os.path.join(self.directory, self.SIZE_FILE),
+                     os.O_RDWR | os.O_CREAT)
+        file_ = os.fdopen(fd, "r+")
+        fcntl.flock(file_, fcntl.LOCK_EX)
+        return file_
+
+    def _read_size(self, file_):
+        """Return the size stored in the locked size file, or None if the
+           file is new, or was left half written.
+        """
+        try:
+            return int(file_.read())
+        except ValueError:
+            return None
+
+    def _write_size(self, file_, size):
+        file_.seek(0)
+        file_.truncate()
+        file_.write(str(size))
+
+    def _change_size(self, delta):
+        """Add `delta` bytes to the stored size, and return the new size.
+           Without a stored size, the cache is scanned once.
+        """
+        with self._lock_size_file() as file_:
+            size = self._read_size(file_)
+            if size is None:
+                size = sum(entry_size for (mtime, entry_size, path)
+                           in self._get_entries())
+            else:
+                size += delta
+            self._write_size(file_, size)
+        return size
+
+    def get_size(self):
+        """Return the total size of all entries, in bytes"""
+        return self._change_size(0)
+
+    def get(self, key):
+        """Return the value stored for `key`, or None.
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as file_:
+                value = pickle.load(file_)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Store `value` for `key`, replacing any earlier value.
+           The file is written under a temporary name and renamed,
+           so that readers never see a half written entry.
+        """
+        path = self._get_path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process in the meantime
+                pass
+        (fd, temp_path) = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as file_:
+            pickle.dump(value, file_, pickle.HIGHEST_PROTOCOL)
+            new_size = file_.tell()
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.rename(temp_path, path)
+
+        if self._change_size(new_size - old_size) > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries, until the cache is
+           well below its maximum size. This scans the whole cache, and
+           holds the size file lock while doing so.
+        """
+        with self._lock_size_file() as size_file:
+            entries = sorted(self._get_entries())
+            size = sum(size for (mtime, size, path) in entries)
+            target = self.max_size * 0.9
+            for (mtime, entry_size, path) in entries:
+                if size <= target:
+                    break
+                try:
+                    os.unlink(path)
+                    size -= entry_size
+                except OSError:
+                    pass
+            self._write_size(size_file, size)
+
+
+_extraction_cache = None
+_ocr_cache = None
+
+
+def get_extraction_cache():
+    """Return the DiskCache for extraction results, or None if
+       `settings.extraction_cache_dir` is not set.
+    """
+    global _extraction_cache
+    directory = getattr(settings, "extraction_cache_dir", None)
+    if directory is None:
+        return None
+    if _extraction_cache is None:
+        max_size = getattr(settings, "extraction_cache_size", DEFAULT_SIZE)
+        _extraction_cache = DiskCache(directory, max_size)
+    return _extraction_cache
+
+
+def get_ocr_cache():
+    """Return the DiskCache for OCR results, or None if
+       `settings.ocr_cache_dir` is not set.
+    """
+    global _ocr_cache
+    directory = getattr(settings, "ocr_cache_dir", None)
+    if directory is None:
+        return None
+    if _ocr_cache is None:
+        max_size = getattr(settings, "ocr_cache_size", DEFAULT_SIZE)
+        _ocr_cache = DiskCache(directory, max_size)
+    return _ocr_cache
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
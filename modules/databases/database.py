@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 """This module contains the base class and error classes
-   for all database classes.
+   for all database classes, and a write buffer that can be put
+   in front of any of them.
 """
 
+import time
+import atexit
+from collections import OrderedDict
+
 
 class DbConnectionError(Exception):
     """The database could not be reached.
@@ -36,9 +41,29 @@ class Database(object):
         """
         raise NotImplementedError('must be overridden by child classes')
 
-    def put(self, key, attr, value):
+    def put(self, key, attr, value, overwrite=False):
+        """Set `attr` to `value`, unless it is already set and
+           `overwrite` is False.
+        """
         raise NotImplementedError('must be overridden by child classes')
 
+    def put_many(self, documents):
+        """Write attributes to many keys at once. `documents` is a
+           dictionary of dictionaries: {key: {attr: (value, overwrite)}}
+
+           Should normally be overwritten by child classes, to use a more
+           efficient method.
+        """
+        for (key, attrs) in documents.iteritems():
+            for (attr, (value, overwrite)) in attrs.iteritems():
+                self.put(key, attr, value, overwrite=overwrite)
+
+    def buffered(self, **kwargs):
+        """Return a WriteBuffer in front of this database.
+           Keyword arguments are passed on to WriteBuffer.
+        """
+        return WriteBuffer(self, **kwargs)
+
     def put_dict(self, key, attr, dict_):
         """Should normally be overwritten by child classes, to use a more
            efficient method.
@@ -52,16 +77,154 @@ class Database(object):
         """Return a value, or None"""
         raise NotImplementedError('must be overridden by child classes')
 
+    def exists_many(self, keys):
+        """Return the set of keys in `keys` that exist.
+
+           Should normally be overwritten by child classes, to use a more
+           efficient method.
+        """
+        return set(key for key in keys if self.exists(key))
+
     def get(self, key, attr):
         """Return a value, or None"""
         raise NotImplementedError('must be overridden by child classes')
 
+    def get_many(self, key, attrs):
+        """Return a dictionary with the values of all attributes in
+           `attrs`, None for missing ones.
+
+           Should normally be overwritten by child classes, to use a more
+           efficient method.
+        """
+        return dict((attr, self.get(key, attr)) for attr in attrs)
+
     def get_attribute_with_value(self, attribute, value):
         """Get a list of keys/rows where a attribute/column has
            the specified value.
         """
         raise NotImplementedError('must be overridden by child classes')
 
+    def get_next_batch_with_value(self, attribute, value, batch_size=500):
+        """Yield lists of at most `batch_size` keys/rows where a
+           attribute/column has the specified value.
+
+           Should normally be overwritten by child classes, to avoid
+           fetching all keys at once.
+        """
+        keys = self.get_attribute_with_value(attribute, value) or []
+        for i in range(0, len(keys), batch_size):
+            yield keys[i:i + batch_size]
+
+    def get_next_attribute_value(self, attribute, batch_size=500):
+        """Yield the value of `attribute` for every key/row that has one.
+        """
+        raise NotImplementedError('must be overridden by child classes')
+
+    def count_attribute_with_value(self, attribute, value):
+        """Return the number of keys/rows where a attribute/column has
+           the specified value.
+        """
+        return len(self.get_attribute_with_value(attribute, value) or [])
+
+    def count_attribute_with_values(self, attribute, values):
+        """Return a dictionary with the number of keys/rows where a
+           attribute/column has each of the specified values.
+
+           Should normally be overwritten by child classes, to use a more
+           efficient method.
+        """
+        return dict((value, self.count_attribute_with_value(attribute, value))
+                    for value in values)
+
+
+class WriteBuffer(object):
+    """Collects attributes written with `put` in memory, and writes all
+       attributes of a key in one go, using `Database.put_many`.
+
+       The buffer is flushed when it holds `max_keys` keys, or when
+       the oldest buffered value is more than `max_age` seconds old
+       (both checked when a new key is put), on `flush()`, on `close()`
+       and at exit. Everything else is passed on to the database, with
+       buffered values taking precedence on reads.
+    """
+
+    def __init__(self, database, max_keys=50, max_age=60):
+        self.database = database
+        self.max_keys = max_keys
+        self.max_age = max_age
+        self._pending = OrderedDict()
+        """{key: {attr: (value, overwrite)}}"""
+        self._oldest = None
+        atexit.register(self.close)
+
+    def put(self, key, attr, value, overwrite=False):
+        """Buffer a value. Returns True, as we can not know yet if it will
+           actually be written.
+        """
+        if key not in self._pending:
+            if (len(self._pending) >= self.max_keys or
+                    (self._oldest is not None and
+                     time.time() - self._oldest > self.max_age)):
+                self.flush()
+            self._pending[key] = {}
+            if self._oldest is None:
+                self._oldest = time.time()
+
+        attrs = self._pending[key]
+        if attr in attrs and not overwrite:
+            # Already set by an earlier put, like it would have been in
+            # the database.
+            return True
+        overwrite = overwrite or attrs.get(attr, (None, False))[1]
+        attrs[attr] = (value, overwrite)
+        return True
+
+    def flush(self):
+        """Write all buffered values to the database.
+        """
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._oldest = None
+        self.database.put_many(pending)
+
+    def close(self):
+        self.flush()
+
+    def exists(self, key):
+        return key in self._pending or self.database.exists(key)
+
+    def exists_many(self, keys):
+        pending = set(key for key in keys if key in self._pending)
+        missing = [key for key in keys if key not in pending]
+        if missing:
+            pending.update(self.database.exists_many(missing))
+        return pending
+
+    def get(self, key, attr):
+        if attr in self._pending.get(key, {}):
+            return self._pending[key][attr][0]
+        return self.database.get(key, attr)
+
+    def get_many(self, key, attrs):
+        pending = self._pending.get(key, {})
+        missing = [attr for attr in attrs if attr not in pending]
+        values = {}
+        if missing:
+            values = self.database.get_many(key, missing)
+        for attr in attrs:
+            if attr in pending:
+                values[attr] = pending[attr][0]
+        return values
+
+    def delete(self, key):
+        self._pending.pop(key, None)
+        return self.database.delete(key)
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
 if __name__ == "__main__":
     print "This module is only intended to be called from other scripts."
     import sys
@@ -18,7 +18,7 @@ class DebuggerDB(Database):
         print "Deleting %s" % key
         return True
 
-    def put(self, key, attr, value):
+    def put(self, key, attr, value, overwrite=False):
         """Will return True if a value was written, or False
         """
         print "Storing %s in %s.%s.%s" % (value, self.table, key, attr)
@@ -39,6 +39,9 @@ class DebuggerDB(Database):
         """
         return None
 
+    def get_next_attribute_value(self, attribute, batch_size=500):
+        return iter([])
+
 if __name__ == "__main__":
     print "This module is only intended to be called from other scripts."
     import sys
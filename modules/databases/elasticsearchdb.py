@@ -4,6 +4,7 @@
 
 from modules.databases.database import Database, DbConnectionError
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import bulk
 from elasticsearch.exceptions import NotFoundError, ConnectionError
 from datetime import datetime
 import logging
@@ -13,6 +14,41 @@ class ElasticSearch(Database):
     """Class for interacting with an ElasticSearch database
     """
 
+    UPDATE_SCRIPT = """
+        changed = false;
+        for (attr in overwrite_attrs.entrySet()) {
+            ctx._source[attr.key] = attr.value;
+            changed = true
+        };
+        for (attr in default_attrs.entrySet()) {
+            if (!ctx._source.containsKey(attr.key)) {
+                ctx._source[attr.key] = attr.value;
+                changed = true
+            }
+        };
+        if (changed) {
+            ctx._source.last_updated = now
+        } else {
+            ctx.op = "none"
+        }
+    """
+    """Sets `overwrite_attrs`, and `default_attrs` where not present.
+       Requires dynamic scripting to be enabled in ElasticSearch, as it
+       is sent inline (`script.disable_dynamic: false` in
+       elasticsearch.yml, needed from ElasticSearch 1.4.3).
+    """
+
+    script_lang = "groovy"
+    """Language of UPDATE_SCRIPT. Groovy is the default scripting
+       language from ElasticSearch 1.3.
+    """
+
+    retry_on_conflict = 3
+    """Number of retries when a document is updated concurrently"""
+
+    scroll_timeout = "5m"
+    """How long to keep a scroll open between two batches"""
+
     def __init__(self, url, index, doctype, port=9200):
         self.index = index
         self.doctype = doctype
@@ -23,10 +59,17 @@ class ElasticSearch(Database):
         es_logger = logging.getLogger("elasticsearch")
         es_logger.setLevel(logging.ERROR)
 
-    def _get_id(self, id):
+    def _get_source(self, id, attrs):
+        """Return the attributes `attrs` of a document, as a dictionary,
+           or None if there is no such document. Only the requested
+           attributes are transferred.
+        """
         try:
-            res = self.es.get(index=self.index, doc_type=self.doctype, id=id)
-            return res["_source"]
+            res = self.es.get(index=self.index,
+                              doc_type=self.doctype,
+                              id=id,
+                              _source_include=list(attrs))
+            return res.get("_source", {})
         except NotFoundError:
             return None
         except ConnectionError:
@@ -40,49 +83,259 @@ class ElasticSearch(Database):
             return None
         return res
 
+    def _get_update_body(self, attrs):
+        """Build the body of an `_update` request, setting the attributes
+           in `attrs` ({attr: (value, overwrite)}). Values that should
+           not overwrite existing ones are handled by a script, so that
+           the stored document never has to be fetched. So are
+           dictionaries that should overwrite existing ones, as a partial
+           update would merge them with the stored ones.
+        """
+        now = datetime.now()
+        overwrite_attrs = {}
+        default_attrs = {}
+        for (attr, (value, overwrite)) in attrs.iteritems():
+            if overwrite:
+                overwrite_attrs[attr] = value
+            else:
+                default_attrs[attr] = value
+
+        upsert = dict(default_attrs)
+        upsert.update(overwrite_attrs)
+        upsert["last_updated"] = now
+
+        replaces_dict = any(isinstance(value, dict)
+                            for value in overwrite_attrs.itervalues())
+        if not default_attrs and not replaces_dict:
+            # A plain partial update will do
+            overwrite_attrs["last_updated"] = now
+            return {"doc": overwrite_attrs, "upsert": upsert}
+        return {
+            "script": self.UPDATE_SCRIPT,
+            "lang": self.script_lang,
+            "params": {
+                "overwrite_attrs": overwrite_attrs,
+                "default_attrs": default_attrs,
+                "now": now
+            },
+            "upsert": upsert
+        }
+
     def put(self, key, attr, value, overwrite=False):
-        """Will return True if a value was written, or False
+        """Set an attribute with a single `_update` request. Unless
+           `overwrite` is True, existing values are left untouched.
+           Returns the ElasticSearch response.
         """
-        body = self._get_id(key) or {}
-        if overwrite or (attr not in body):
-            body[attr] = value
-            body["last_updated"] = datetime.now()
-            result = self.es.index(index=self.index,
-                                   doc_type=self.doctype,
-                                   id=key,
-                                   body=body)
-            return result
-        else:
+        body = self._get_update_body({attr: (value, overwrite)})
+        try:
+            return self.es.update(index=self.index,
+                                  doc_type=self.doctype,
+                                  id=key,
+                                  body=body,
+                                  retry_on_conflict=self.retry_on_conflict)
+        except ConnectionError:
+            raise DbConnectionError
+
+    def put_many(self, documents):
+        """Write attributes to many keys, with one `_update` action per
+           key, all in a single `_bulk` request.
+           `documents` is on the form {key: {attr: (value, overwrite)}}
+        """
+        actions = []
+        for (key, attrs) in documents.iteritems():
+            action = self._get_update_body(attrs)
+            action.update({"_op_type": "update",
+                           "_index": self.index,
+                           "_type": self.doctype,
+                           "_id": key,
+                           "_retry_on_conflict": self.retry_on_conflict})
+            actions.append(action)
+        if not actions:
             return False
+        try:
+            return bulk(self.es, actions)
+        except ConnectionError:
+            raise DbConnectionError
 
     def exists(self, key):
-        res = self._get_id(key)
-        return res is not None
+        """Check for a document with a HEAD request.
+        """
+        try:
+            return self.es.exists(index=self.index,
+                                  doc_type=self.doctype,
+                                  id=key)
+        except ConnectionError:
+            raise DbConnectionError
+
+    def exists_many(self, keys):
+        """Check for many documents with one `_mget` request, without
+           fetching any content. Returns the set of existing keys.
+        """
+        keys = list(keys)
+        if not keys:
+            return set()
+        try:
+            res = self.es.mget(index=self.index,
+                               doc_type=self.doctype,
+                               body={"ids": keys},
+                               _source=False)
+        except ConnectionError:
+            raise DbConnectionError
+        return set(doc["_id"] for doc in res["docs"] if doc.get("found"))
 
     def get(self, key, attr):
-        res = self._get_id(key)
+        res = self._get_source(key, [attr])
         if res is not None and attr in res:
             return res[attr]
         else:
             return None
 
+    def get_many(self, key, attrs):
+        res = self._get_source(key, attrs) or {}
+        return dict((attr, res.get(attr)) for attr in attrs)
+
+    def _get_term_query(self, attribute, value):
+        return {
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "term": {
+                            attribute: value
+                        }
+                    }
+                }
+            }
+        }
+
+    def _scroll(self, body, batch_size):
+        """Yield all hits for a search, one list of hits at a time,
+           using the scan and scroll API.
+           `batch_size` is per shard.
+        """
+        scroll_id = None
+        try:
+            res = self.es.search(index=self.index,
+                                 doc_type=self.doctype,
+                                 body=body,
+                                 search_type="scan",
+                                 scroll=self.scroll_timeout,
+                                 size=batch_size)
+            scroll_id = res["_scroll_id"]
+            while True:
+                res = self.es.scroll(scroll_id=scroll_id,
+                                     scroll=self.scroll_timeout)
+                scroll_id = res["_scroll_id"]
+                hits = res["hits"]["hits"]
+                if not hits:
+                    break
+                yield hits
+        except ConnectionError:
+            raise DbConnectionError
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    # The scroll will time out anyway
+                    pass
+
+    def get_next_batch_with_value(self, attribute, value, batch_size=500):
+        """Yield lists of keys where a attribute has the specified value,
+           until all matching keys are returned.
+        """
+        body = self._get_term_query(attribute, value)
+        body["fields"] = []
+        for hits in self._scroll(body, batch_size):
+            yield [hit["_id"] for hit in hits]
+
+    def get_next_attribute_value(self, attribute, batch_size=500):
+        """Yield the value of `attribute` for all documents that have one,
+           fetching only that attribute.
+        """
+        body = {
+            "query": {
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "exists": {
+                            "field": attribute
+                        }
+                    }
+                }
+            },
+            "_source": [attribute]
+        }
+        for hits in self._scroll(body, batch_size):
+            for hit in hits:
+                yield hit["_source"].get(attribute)
+
     def get_attribute_with_value(self, attribute, value):
-        """Get a list of keys/rows where a attribute/column has
-           the specified value.
+        """Get a list of all keys where a attribute has the
+           specified value.
+        """
+        keys = []
+        for batch in self.get_next_batch_with_value(attribute, value):
+            keys.extend(batch)
+        return keys
+
+    def count_attribute_with_value(self, attribute, value):
+        """Return the number of keys where a attribute has the
+           specified value.
         """
-        hits = self.es.search(index=self.index, body={
+        try:
+            res = self.es.count(index=self.index,
+                                doc_type=self.doctype,
+                                body=self._get_term_query(attribute, value))
+        except ConnectionError:
+            raise DbConnectionError
+        return res["count"]
+
+    def count_attribute_with_values(self, attribute, values):
+        """Count keys for many values of an attribute, with one terms
+           aggregation, rather than one count request per value.
+        """
+        values = list(set(values))
+        counts = dict((value, 0) for value in values)
+        if not values:
+            return counts
+        body = {
             "query": {
-                "match_all": {}
+                "filtered": {
+                    "query": {
+                        "match_all": {}
+                    },
+                    "filter": {
+                        "terms": {
+                            attribute: values
+                        }
+                    }
+                }
             },
-            "fields": [],
-            "filter": {
-                "term": {
-                    attribute: value
+            "aggs": {
+                "counts": {
+                    "terms": {
+                        "field": attribute,
+                        "size": len(values)
+                    }
                 }
-            }
-        })
-        hits = hits["hits"]["hits"]
-        return [hit["_id"] for hit in hits]
+            },
+            "size": 0
+        }
+        try:
+            res = self.es.search(index=self.index,
+                                 doc_type=self.doctype,
+                                 body=body)
+        except ConnectionError:
+            raise DbConnectionError
+        for bucket in res["aggregations"]["counts"]["buckets"]:
+            if bucket["key"] in counts:
+                counts[bucket["key"]] = bucket["doc_count"]
+        return counts
 
 if __name__ == "__main__":
     print "This module is only intended to be called from other scripts."
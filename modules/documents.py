@@ -19,6 +19,14 @@ document_headers = {
 }
 
 
+def should_store(document):
+    """Return True if documents of this type should be stored, according
+       to `settings.stored_document_types`.
+    """
+    stored_types = getattr(settings, "stored_document_types", None)
+    return stored_types is None or document.type_ in stored_types
+
+
 class DocumentList(object):
     """Contains a list of documents, extracted from a file.
     """
@@ -29,6 +37,12 @@ class DocumentList(object):
 
         self._documents = []
 
+        self.pages = []
+        """(page, header, date) for each page, with the header and date
+           as seen by Document. Stored in page sidecars, see
+           modules/sidecar.py
+        """
+
         page_types_and_dates = []
         """Keep track of documents by type and date, to be able to merge
            documents depending on `settings.document_type_settings`
@@ -41,6 +55,7 @@ class DocumentList(object):
         try:
             for page in extractor.get_next_page():
                 temp_doc = Document(page, extractor)
+                self.pages.append((page, temp_doc.header, temp_doc.date))
 
                 if (len(documents) > 0 and
                    temp_doc.type_ == last_page_type and
@@ -88,39 +103,57 @@ class DocumentList(object):
 
 
 class Document(object):
-    """Represents a single document
+    """Represents a single document. The text is not fetched from the
+       pages until asked for, so that pages of documents that are never
+       stored (see `should_store`) can skip expensive work, like OCR.
     """
-    text = ""
     header = ""
     date = None
     type_ = None
+    pages = None
+    """Page numbers of the pages in this document"""
 
     def __init__(self, page, extractor):
-        """Create a document stub from a page. Use add_page
+        """Create a document stub from a page. Use merge_with
            to keep extending this document.
         """
-        self.text = page.get_text()
+        self._page_objects = [page]
+        self._text = None
         self.header = page.get_header() or extractor.get_header()
         self.date = page.get_date() or extractor.get_date()
         self.type_ = self.get_document_type()
-        self.date = page.get_date() or extractor.get_date()
+        self.pages = [page.page_number]
+
+    @property
+    def text(self):
+        """All text from the pages of this document"""
+        if self._text is None:
+            self.prefetch_text()
+            texts = [page.get_text() for page in self._page_objects]
+            try:
+                self._text = "".join(texts)
+            except UnicodeDecodeError:
+                self._text = u"".join(make_unicode(x) for x in texts)
+        return self._text
 
-    def append_page(self, page):
-        """Append content from a page to this document.
+    def prefetch_text(self):
+        """Let pages start working on their text in the background, where
+           possible, e.g. OCR in threads.
         """
-        pass
+        for page in self._page_objects:
+            page.prefetch_text()
 
-    def append_text(self, text):
-        """Append content to this document.
+    def is_text_ready(self):
+        """Return False if the text of some page can not be had. See
+           Page.is_text_ready.
         """
-        self.text += text
+        return all(page.is_text_ready() for page in self._page_objects)
 
     def merge_with(self, document):
         """Merge this document with another one"""
-        try:
-            self.text += document.text
-        except UnicodeDecodeError:
-            self.text = make_unicode(self.text) + make_unicode(document.text)
+        self.pages = self.pages + document.pages
+        self._page_objects = self._page_objects + document._page_objects
+        self._text = None
 
     def __len__(self):
         """len is the length of the total plaintext"""
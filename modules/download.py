@@ -116,12 +116,14 @@ class File(object):
     def get_file_extension(self):
         return FileType.type_to_ext_dict.get(self.get_file_type(), None)
 
-    def extractor(self):
-        """Returns an extractor object suitable for analyzing this file
+    def extractor(self, **kwargs):
+        """Returns an extractor object suitable for analyzing this file.
+           Keyword arguments, e.g. `temp_space`, are passed on to the
+           extractor.
         """
         Extractor = FileType.type_to_extractor_dict.get(self.get_file_type(),
                                                         None)
-        extractor = Extractor(self.localFile)
+        extractor = Extractor(self.localFile, **kwargs)
         return extractor
 
 
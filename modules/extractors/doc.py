@@ -5,6 +5,7 @@
 
 from modules.extractors.documentBase import ExtractorBase, Page
 from modules.extractors.documentBase import CompatibilityError
+from modules.extractors.documentBase import cached_pages, cached_value
 
 import subprocess
 from modules.metadata import Metadata
@@ -43,12 +44,13 @@ class DocExtractor(ExtractorBase):
                 metadata.add({parts[0]: parts[1]}, "mso")
         return metadata
 
+    @cached_value("header")
     def get_header(self):
         """Uses Abiword to return the first page header encountered.
         """
         import subprocess
         import os
-        temp_filename = os.path.join("temp", "tmp.abw")
+        temp_filename = self.get_temp_space().get_path("tmp.abw")
         try:
             arglist = ["abiword",
                        self.path,
@@ -82,6 +84,7 @@ class DocExtractor(ExtractorBase):
         os.unlink(temp_filename)
         return text
 
+    @cached_pages
     def get_next_page(self):
         """Returns all the text in one single page.
            We might be able to use e.g. Abiword to calculate
@@ -101,7 +104,7 @@ class DocExtractor(ExtractorBase):
 
         import subprocess
         import os
-        temp_filename = os.path.join("temp", "tmp.txt")
+        temp_filename = self.get_temp_space().get_path("tmp.txt")
         try:
             arglist = ["abiword",
                        self.path,
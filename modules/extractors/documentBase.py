@@ -2,7 +2,11 @@
 """This module contains the base class for all document classes.
 """
 
+from functools import wraps
+
 from modules.utils import get_date_from_text, get_single_date_from_text
+from modules.utils import md5sum
+from modules.tempspace import TempSpace
 
 
 class ExtractionNotAllowed(Exception):
@@ -16,6 +20,12 @@ class CompatibilityError(Exception):
     """
 
 
+class ExtractionBudgetExceeded(Exception):
+    """This file needs more work than allowed, e.g. OCR of more pages
+       than `settings.extraction_max_ocr_pages`.
+    """
+
+
 class DocumentType(object):
     """Store document types.
     """
@@ -30,6 +40,9 @@ class Page(object):
        Used in extractor classes.
     """
 
+    __slots__ = ()
+    """Lets subclasses, such as CachedPage, do without a __dict__"""
+
     page_number = None
     """Starting with 1, this is the position of this Page object
        within a file. This is not necessarily the same thing as
@@ -39,6 +52,9 @@ class Page(object):
        case of .doc files, etc.)
     """
 
+    ocr_resolution = None
+    """Resolution, in dpi, that this page was OCR:ed at, if it was"""
+
     def __init__(self):
         pass
 
@@ -55,11 +71,40 @@ class Page(object):
         """
         return None
 
+    def is_text_ready(self):
+        """Return False if get_text can not return the text of this page.
+           Pages that do expensive work in get_text, e.g. OCR, should still
+           return True, as should pages that are waiting for such work.
+        """
+        return True
+
+    def is_text_done(self):
+        """Return True if the text of this page is at hand, without
+           further work. Used to store only text that was actually needed.
+        """
+        return self.is_text_ready()
+
+    def prefetch_text(self):
+        """Called when the text of this page will soon be needed, for
+           pages that can start working on it in the background.
+        """
+        pass
+
     def get_date(self):
         """Returns a datetime date from the page header.
         """
         return get_single_date_from_text(self.get_header())
 
+    def compact(self):
+        """Return a CachedPage with the text, header and date of this
+           page, so that anything else the page holds can be released.
+        """
+        return CachedPage(self.page_number,
+                          self.get_text(),
+                          self.get_header(),
+                          self.get_date(),
+                          self.ocr_resolution)
+
     def word_count(self):
         """Returns the number of non whitespace characters.
 
@@ -70,15 +115,187 @@ class Page(object):
         return len(char_list)
 
 
+class CachedPage(Page):
+    """A page restored from stored values, rather than extracted.
+       `text` can be None, if it was never needed when the page was
+       extracted. `text_loader(page_number)`, if given, is then used to
+       get it.
+
+       Also used as a compact stand in for extracted pages, that no
+       longer need their layout (see Page.compact).
+    """
+
+    __slots__ = ("page_number", "_text", "_header", "_date",
+                 "ocr_resolution", "_text_loader")
+
+    def __init__(self, page_number, text, header, date,
+                 ocr_resolution=None, text_loader=None):
+        self.page_number = page_number
+        self._text = text
+        self._header = header
+        self._date = date
+        self.ocr_resolution = ocr_resolution
+        self._text_loader = text_loader
+
+    def get_text(self):
+        if self._text is None and self._text_loader is not None:
+            self._text = self._text_loader(self.page_number)
+        return self._text
+
+    def is_text_ready(self):
+        return self._text is not None or self._text_loader is not None
+
+    def is_text_done(self):
+        return self._text is not None
+
+    def get_header(self):
+        return self._header
+
+    def get_date(self):
+        return self._date
+
+
+def cached_pages(get_next_page):
+    """Decorator for `get_next_page` in extractor classes. Yields pages
+       from the extraction cache, if the file has been extracted before.
+       Otherwise the pages are recorded, and cached on `close()`.
+    """
+    @wraps(get_next_page)
+    def wrapper(self):
+        if self.cache is None:
+            for page in get_next_page(self):
+                yield page
+            return
+
+        record = self._get_cache_record()
+        if "pages" in record:
+            for page_values in record["pages"]:
+                yield CachedPage(*page_values,
+                                 text_loader=self.get_page_text)
+            return
+
+        pages = []
+        for page in get_next_page(self):
+            pages.append(page)
+            yield page
+        # Only complete extractions are cached
+        self._pages_to_cache = pages
+    return wrapper
+
+
+def cached_value(name):
+    """Decorator for extractor methods that take no arguments, e.g.
+       `get_header`, to store their return value in the extraction cache.
+       Without a cache, the value is kept in memory, so that the method
+       runs once per extractor either way.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self):
+            if self.cache is None:
+                if self._values is None:
+                    self._values = {}
+                record = self._values
+            else:
+                record = self._get_cache_record()
+            if name not in record:
+                record[name] = method(self)
+                if self.cache is not None:
+                    self._cache_record_changed = True
+            return record[name]
+        return wrapper
+    return decorator
+
+
 class ExtractorBase(object):
     """Base class for extractor classes for various document types.
        Contains some common functionality, and definitions of
        mandatory methods for sub classes.
     """
 
-    def __init__(self, path):
+    version = 1
+    """Increase this when a change to an extractor changes its output,
+       to invalidate cached extraction results.
+    """
+
+    cache = None
+    _cache_record = None
+    _cache_record_changed = False
+    _pages_to_cache = None
+    _values = None
+    """Values of cached_value methods, when there is no cache"""
+
+    def __init__(self, path, temp_space=None, cache=None):
+        """`temp_space` is a tempspace.TempSpace for temporary files.
+           If not given, the extractor will create one of its own when
+           needed, and remove it on close().
+
+           `cache` is a cache.DiskCache for extraction results, if any.
+        """
         self.path = path
         self.text = None
+        self._temp_space = temp_space
+        self._owns_temp_space = False
+        self.cache = cache
+
+    def get_cache_settings(self):
+        """Return anything, besides the file itself, that affects the
+           output of this extractor, e.g. settings. Used in the cache key.
+        """
+        return ()
+
+    def _get_cache_key(self):
+        from hashlib import md5
+        parts = [md5sum(self.path),
+                 type(self).__name__,
+                 str(self.version),
+                 repr(self.get_cache_settings())]
+        return md5("|".join(parts)).hexdigest()
+
+    def _get_cache_record(self):
+        """Return the dictionary of cached values for this file,
+           extractor and settings.
+        """
+        if self._cache_record is None:
+            self._cache_key = self._get_cache_key()
+            self._cache_record = self.cache.get(self._cache_key) or {}
+        return self._cache_record
+
+    def _store_cache_record(self):
+        if self._pages_to_cache is not None:
+            # Text that was never needed is not fetched now
+            self._cache_record["pages"] = [(page.page_number,
+                                            page.get_text()
+                                            if page.is_text_done() else None,
+                                            page.get_header(),
+                                            page.get_date(),
+                                            page.ocr_resolution)
+                                           for page in self._pages_to_cache]
+            self._pages_to_cache = None
+            self._cache_record_changed = True
+        if self._cache_record_changed:
+            self.cache.put(self._cache_key, self._cache_record)
+            self._cache_record_changed = False
+
+    def get_temp_space(self):
+        """Return the TempSpace where this extractor should put all
+           temporary files.
+        """
+        if self._temp_space is None:
+            self._temp_space = TempSpace()
+            self._owns_temp_space = True
+        return self._temp_space
+
+    def close(self):
+        """Store results in the extraction cache, if any, and release
+           resources held by this extractor.
+        """
+        if self._cache_record is not None:
+            self._store_cache_record()
+        if self._owns_temp_space:
+            self._temp_space.cleanup()
+            self._temp_space = None
+            self._owns_temp_space = False
 
     def get_metadata(self):
         """Should return a metadata.Metadata object
@@ -101,6 +318,14 @@ class ExtractorBase(object):
         """
         raise NotImplementedError('must be overridden by child classes')
 
+    def get_page_text(self, page_number):
+        """Return the text of a single page. Needed by extractors with
+           pages that fetch their text lazily, to get text for cached
+           pages that was not needed when they were first extracted.
+        """
+        raise NotImplementedError('must be overridden by child classes')
+
+    @cached_value("date")
     def get_date(self):
         """Return a best guess for the date of the meeting
            this document refers to, based on the whole text.
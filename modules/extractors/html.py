@@ -4,6 +4,7 @@
 """
 
 from modules.extractors.documentBase import ExtractorBase, Page
+from modules.extractors.documentBase import cached_pages, cached_value
 from modules.metadata import Metadata
 
 from bs4 import BeautifulSoup
@@ -37,8 +38,10 @@ class HtmlExtractor(ExtractorBase):
     """Class for handling HTML file data extraction.
     """
 
-    def __init__(self, path, **kwargs):
-        self.path = path
+    def __init__(self, path, temp_space=None, cache=None, **kwargs):
+        super(HtmlExtractor, self).__init__(path,
+                                            temp_space=temp_space,
+                                            cache=cache)
         self.content_xpath = kwargs.get('html', '//body')
         self.content_soup = None
         self.content_html = None
@@ -55,6 +58,11 @@ class HtmlExtractor(ExtractorBase):
             self.content_html = html
             self.content_soup = BeautifulSoup(html)
 
+    def get_cache_settings(self):
+        """The content xpath decides what text we get"""
+        return (self.content_xpath,)
+
+    @cached_pages
     def get_next_page(self):
         """Return the whole document in one page (we have no such
            cases in the wild yet, but one could imagine splitting
@@ -64,6 +72,7 @@ class HtmlExtractor(ExtractorBase):
         page._text = self.get_text()
         yield page
 
+    @cached_value("header")
     def get_header(self):
         """Return a best guess for the header (if any) of this page,
            or None if no headers were found.
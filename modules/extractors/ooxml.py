@@ -4,6 +4,7 @@
 """
 
 from modules.extractors.documentBase import ExtractorBase, Page
+from modules.extractors.documentBase import cached_pages, cached_value
 
 from docx import Document
 import openxmllib  # good for metadata, bad for text
@@ -35,6 +36,7 @@ class DocxExtractor(ExtractorBase):
         self.metadata.add(document.allProperties, "ooxml")
         return self.metadata
 
+    @cached_value("header")
     def get_header(self):
         """Our docx library has no support for headers yet.
            For now carve out the header ourselves by parsing xml files.
@@ -98,6 +100,7 @@ class DocxExtractor(ExtractorBase):
         return "\n".join(headers)
 
 
+    @cached_pages
     def get_next_page(self):
         """Returns all the text in one single page.
            We might be able to use e.g. Abiword to calculate
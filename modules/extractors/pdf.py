@@ -4,28 +4,34 @@
 """
 
 import logging
+from collections import deque
+
+import settings
 
 from modules.extractors.documentBase import ExtractorBase, Page
 from modules.extractors.documentBase import\
-    ExtractionNotAllowed, CompatibilityError
+    ExtractionNotAllowed, CompatibilityError, ExtractionBudgetExceeded
+from modules.extractors.documentBase import cached_pages, cached_value
+from modules.extractors.documentBase import CachedPage
 from modules.metadata import Metadata
 from modules.xmp import xmp_to_dict
-from modules.utils import make_unicode
-from modules.extractors.pdfUtils import Stream
+from modules.utils import make_unicode, get_date_from_text
+from modules.extractors.pdfUtils import Stream, PageRenderer, decode_image
+from modules.extractors.pdfUtils import PdftotextReader
+from modules.tempspace import TempSpace
+from modules.ocr import get_ocr_service
 
 from PIL import Image
 from os import unlink
 from os import path as os_path
 
-from pytesseract import image_to_string
-
 from pdfminer.pdfparser import PDFParser, PSEOF, PDFSyntaxError
 from pdfminer.pdfdocument import PDFDocument, PDFEncryptionError
 from pdfminer.pdfpage import PDFPage, PDFTextExtractionNotAllowed
 from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
 from pdfminer.layout import LAParams, LTTextBox, LTTextLine, LTFigure, LTImage
 from pdfminer.converter import PDFPageAggregator
-from pdfminer.pdftypes import resolve1, PDFNotImplementedError
+from pdfminer.pdftypes import resolve1, PDFNotImplementedError, PDFStream
 from pdfminer.image import ImageWriter
 
 
@@ -36,8 +42,10 @@ class PDFError(Exception):
 class PdfImage(object):
     """Class representing an image in a PDF."""
 
-    def __init__(self, image_obj):
-        """Takes a PDFMiner LTImage object."""
+    def __init__(self, image_obj, temp_space=None):
+        """Takes a PDFMiner LTImage object, and optionally the
+           tempspace.TempSpace to export images to.
+        """
         if image_obj.stream is None:
             raise Exception("No image stream")
 
@@ -47,19 +55,34 @@ class PdfImage(object):
 
         self._stream = image_obj.stream
         self._image_obj = image_obj
+        self.temp_space = temp_space
 
     def get_text(self):
-        """Does OCR on this image."""
-        image_writer = ImageWriter("temp")
+        """Does OCR on this image. Images that we can decode ourselves
+           are handed to OCR in memory, others are exported to files
+           by PdfMiner first.
+        """
+        image = decode_image(self._stream)
+        if image is not None:
+            return get_ocr_service().image_to_string(image, lang="swe")
+        if self.temp_space is None:
+            with TempSpace() as temp_space:
+                return self._do_ocr(temp_space)
+        return self._do_ocr(self.temp_space)
+
+    def _do_ocr(self, temp_space):
+        image_dir = temp_space.get_dir("images")
+        image_writer = ImageWriter(image_dir)
         try:
-            temp_image = image_writer.export_image(self._image_obj)
+            image_name = image_writer.export_image(self._image_obj)
         except PDFNotImplementedError:
             # No filter method available for this stream
             # https://github.com/euske/pdfminer/issues/99
             return u""
+        image_path = os_path.join(image_dir, image_name)
         try:
-            text = image_to_string(Image.open("temp/" + temp_image),
-                                   lang="swe")
+            text = get_ocr_service().image_to_string(Image.open(image_path),
+                                                     lang="swe")
         except IOError:
             # PdfMiner did not return an image
             # Let's try to create one ourselves
@@ -70,18 +93,41 @@ class PdfImage(object):
                                           self._image_obj.srcsize,
                                           self._stream.get_data(), "raw",
                                           "L", 0, 1)
-            text = image_to_string(temp_image, lang="swe")
-        unlink("temp/" + temp_image)
+            text = get_ocr_service().image_to_string(temp_image,
+                                                     lang="swe")
+        unlink(image_path)
         return text
 
 
+def _get_header_bottom(page_bbox):
+    """Return the y coordinate, counted from the bottom of the page, that
+       layout objects must be above to be part of the page header.
+    """
+    return (page_bbox[3] - page_bbox[0]) * 0.8
+
+
+class HeaderBandAggregator(PDFPageAggregator):
+    """A PDFPageAggregator that drops everything below the header band of
+       a page before layout analysis, so that only the header is
+       analysed. Text that straddles the band might be grouped
+       differently than in a full analysis.
+    """
+
+    def end_page(self, page):
+        bottom = _get_header_bottom(self.cur_item.bbox)
+        self.cur_item._objs = [obj for obj in self.cur_item._objs
+                               if obj.bbox[1] >= bottom]
+        super(HeaderBandAggregator, self).end_page(page)
+
+
 class PdfPage(Page):
     """Class containing PDF pages extracted with PdfMinerWrapper.
     """
 
-    def __init__(self, page_object, page_number):
+    def __init__(self, page_object, page_number, temp_space=None):
         self.LTPage = page_object
         self.page_number = page_number
+        self.temp_space = temp_space
 
     def get_text(self):
         """Iterate through the list of LT* objects and capture all text.
@@ -111,8 +157,7 @@ class PdfPage(Page):
         except AttributeError:  # cache is not there
             pass
 
-        page_bbox = self.LTPage.bbox
-        top_fifth = (page_bbox[3] - page_bbox[0]) * 0.8
+        top_fifth = _get_header_bottom(self.LTPage.bbox)
 
         # Get all objects containing text
         all_objects = []
@@ -161,7 +206,7 @@ class PdfPage(Page):
         elif (isinstance(lt_obj, LTImage)) and (do_ocr is True):
             # An image
             try:
-                image = PdfImage(lt_obj)
+                image = PdfImage(lt_obj, self.temp_space)
                 text_content.append(image.get_text())
             except Exception:
                 pass
@@ -173,16 +218,119 @@ class PdfPage(Page):
             return ""
 
 
+HEADER_BAND = 0.2
+"""Top part of a scanned page to OCR for the header, before deciding if
+   the rest is needed
+"""
+
+
+def get_ocr_resolutions():
+    """Return the resolutions to OCR scanned pages at, lowest first.
+       See `settings.ocr_resolutions`.
+    """
+    return sorted(getattr(settings, "ocr_resolutions", None) or [600])
+
+
+def ocr_header_first():
+    """Return True if scanned pages should have only their header band
+       OCR:ed at first. That pays off only if some document types are not
+       stored (see `settings.stored_document_types`), as the text of all
+       other pages will be needed anyway.
+    """
+    return getattr(settings, "stored_document_types", None) is not None
+
+
 class PdfPageFromOcr(PdfPage):
-    """Represents a OCR:ed page from a PDF file
+    """Represents a OCR:ed page from a PDF file.
+
+       With `header_first`, only the top band of the page is OCR:ed at
+       first, for the header, as that is enough to tell what document the
+       page belongs to. Only the header text is kept. If the text of the
+       page is asked for, the page is rendered again, and OCR:ed as a
+       whole, so that no page images pile up while the rest of the file
+       is parsed. Otherwise the whole page is OCR:ed right away, and the
+       header is taken from its text.
     """
-    def __init__(self, path, page_number):
+    def __init__(self, path, page_number, temp_space, renderer=None,
+                 in_background=False, header_first=True):
+        """`renderer` is a pdfUtils.PageRenderer, that can render this
+           page at the lowest OCR resolution. If not given, one is started
+           for this page only.
+
+           With `in_background`, OCR is done by the OCR service's thread
+           pool, and get_header and get_text will wait for it to finish.
+
+           `header_first` should be False when the text of the page will
+           most likely be needed anyway. See `ocr_header_first`.
+        """
         self.pdf_path = path
         self.page_number = page_number
-        self._text_cache = self.do_ocr()
+        self.temp_space = temp_space
+        self.in_background = in_background
+        self._header_result = None
+        self._header_text = None
+        self._text_result = None
+
+        image = self.get_image(renderer)
+        if not header_first:
+            if in_background:
+                self._text_result = get_ocr_service().apply_async(
+                    self.do_ocr, (image,))
+            else:
+                self._text_cache = self.do_ocr(image)
+            return
+        (width, height) = image.size
+        band = image.crop((0, 0, width, int(height * HEADER_BAND)))
+        # Copy the band out, not to keep the full page while OCR is queued
+        band.load()
+        if in_background:
+            self._header_result = get_ocr_service().apply_async(
+                self._ocr_header, (band,))
+        else:
+            self._header_text = self._ocr_header(band)
+
+    def _ocr_header(self, band):
+        return get_ocr_service().image_to_string(band, lang="swe")
+
+    def _get_header_text(self):
+        if self._header_result is not None:
+            self._header_text = self._header_result.get()
+            self._header_result = None
+        if self._header_text is None:
+            # The whole page was OCR:ed, without a header band
+            return self.get_text()
+        return self._header_text
+
+    def _ocr_page(self):
+        """Render the page again, and OCR all of it.
+        """
+        return self.do_ocr(self.get_image())
+
+    def prefetch_text(self):
+        """Start OCR:ing the whole page in the background, if OCR
+           threads are used.
+        """
+        if (self.in_background and self._text_result is None and
+           not self.is_text_done()):
+            self._text_result = get_ocr_service().apply_async(self._ocr_page)
+
+    def get_text(self):
+        try:
+            return self._text_cache
+        except AttributeError:  # not OCR:ed yet
+            pass
+        if self._text_result is not None:
+            self._text_cache = self._text_result.get()
+            self._text_result = None
+        else:
+            self._text_cache = self._ocr_page()
+        return self._text_cache
+
+    def is_text_done(self):
+        return hasattr(self, "_text_cache")
 
     def get_header(self):
-        rows = self.get_text().split("\n")
+        rows = self._get_header_text().split("\n")
         i = 0
         header_text = []
         for row in rows:
@@ -199,129 +347,647 @@ class PdfPageFromOcr(PdfPage):
                 i += 1
         return '\n'.join(header_text)
 
-    def do_ocr(self):
-        import subprocess
-        temp_filename = os_path.join("temp", "ocr.png")
-        try:
-            arglist = ["gs",
-                       "-dSAFE",
-                       "-dQUIET",
-                       "-o" + temp_filename,
-                       "-sDEVICE=pnggray",
-                       "-r600",
-                       "-dFirstPage=" + str(self.page_number),
-                       "-dLastPage=" + str(self.page_number),
-                       self.pdf_path]
-            subprocess.call(args=arglist, stderr=subprocess.STDOUT)
-        except OSError as e:
-            logging.error("Failed to run GhostScript." +
-                          "I/O error({0}): {1}".format(e.errno, e.strerror))
-        # Do OCR
-        import time
-        time.sleep(1)  # make sure the server has time to write the files
-        text = image_to_string(
-            Image.open(temp_filename),
-            lang="swe")
-        unlink(temp_filename)
+    def get_image(self, renderer=None, resolution=None):
+        """Return this page as a PIL Image, for OCR, from `renderer`, or
+           rendered at `resolution` (default: the lowest OCR resolution).
+        """
+        if renderer is None:
+            resolution = resolution or get_ocr_resolutions()[0]
+            renderer = PageRenderer(self.pdf_path,
+                                    self.page_number,
+                                    self.page_number,
+                                    resolution=resolution)
+            try:
+                image = renderer.get_image(self.page_number)
+            finally:
+                renderer.close()
+        else:
+            image = renderer.get_image(self.page_number)
+        return image
+
+    def do_ocr(self, image):
+        """OCR this page from `image`, rendered at the lowest resolution.
+           While Tesseract's confidence is below
+           `settings.ocr_min_confidence`, render the page again at the next
+           resolution, and retry. The resolution used is kept in
+           `ocr_resolution`.
+        """
+        ocr_service = get_ocr_service()
+        resolutions = get_ocr_resolutions()
+        min_confidence = getattr(settings, "ocr_min_confidence", 60)
+
+        (text, confidence) = ocr_service.image_to_string_with_confidence(
+            image, lang="swe")
+        self.ocr_resolution = resolutions[0]
+        for resolution in resolutions[1:]:
+            if confidence is None or confidence >= min_confidence:
+                break
+            logging.info("OCR confidence %d on page %d, trying %d dpi" %
+                         (confidence, self.page_number, resolution))
+            image = self.get_image(resolution=resolution)
+            (text, confidence) = ocr_service.image_to_string_with_confidence(
+                image, lang="swe")
+            self.ocr_resolution = resolution
         return text
 
 
+class PdfPageWithoutFonts(PdfPage):
+    """A PDF page that uses no fonts, and so can not have any text.
+       Layout analysis is skipped for these pages.
+    """
+
+    def __init__(self, page_number, temp_space=None):
+        self.LTPage = []
+        self.page_number = page_number
+        self.temp_space = temp_space
+
+    def get_header(self):
+        return u""
+
+
+class PdftotextPage(Page):
+    """Represents a page read with pdftotext (see
+       pdfUtils.PdftotextReader), rather than PdfMiner's layout analysis.
+    """
+
+    def __init__(self, page_number, width, height, words):
+        """`words` is a list of (x0, y0, x1, y1, text), with y counted
+           from the top of the page, in pdftotext's reading order.
+        """
+        self.page_number = page_number
+        self.height = height
+        self.lines = self._get_lines(words)
+        """List of (y0, y1, text)"""
+
+    def _get_lines(self, words):
+        """Join words into lines. A word that starts below the previous
+           one, or to the left of it, starts a new line.
+        """
+        lines = []
+        line_words = []
+        (top, bottom, right) = (None, None, None)
+        for (x0, y0, x1, y1, text) in words:
+            if line_words and (y0 >= bottom or x0 < right):
+                lines.append((top, bottom, u" ".join(line_words)))
+                line_words = []
+            if not line_words:
+                (top, bottom) = (y0, y1)
+            line_words.append(make_unicode(text))
+            (top, bottom, right) = (min(top, y0), max(bottom, y1), x1)
+        if line_words:
+            lines.append((top, bottom, u" ".join(line_words)))
+        return lines
+
+    def get_text(self):
+        return u"\n".join(text for (y0, y1, text) in self.lines)
+
+    def get_header(self):
+        """Return the lines at the top of the page, like
+           PdfPage.get_header does with text boxes.
+        """
+        header_texts = []
+        i = 0
+        for (y0, y1, text) in sorted(self.lines):
+            text_length = len(text.strip())
+            if text_length > 100:  # break on first paragraph
+                break
+            elif i > 5:  # or break on 8th line with content
+                break
+            elif y1 > self.height * HEADER_BAND:
+                break
+            header_texts.append(text)
+            if text_length > 0:
+                i += 1
+        return u" ".join(header_texts)
+
+
+STREAMING_MIN_PAGES = 100
+"""Default for `settings.pdf_streaming_min_pages`"""
+
+RANGE_MIN_PAGES = 200
+"""Default for `settings.pdf_range_min_pages`"""
+
+RANGES_PER_PROCESS = 4
+"""Number of page ranges to split a file into, per process, so that
+   processes that get easy ranges can take on more.
+"""
+
+
+def get_pdf_text_engine():
+    """Return the engine to read text from PDF pages with.
+       See `settings.pdf_text_engine`.
+    """
+    engine = getattr(settings, "pdf_text_engine", None) or "pdfminer"
+    if engine not in ("pdfminer", "pdftotext"):
+        raise ValueError("Unknown PDF text engine: %s" % engine)
+    return engine
+
+
+def _has_fonts(resources, depth=0):
+    """Return True if a PDF resource dictionary, or that of any form
+       XObject it uses, contains fonts. Pages without a resource
+       dictionary might still show text, with a default font.
+    """
+    resources = resolve1(resources)
+    if not isinstance(resources, dict):
+        return True
+    if resolve1(resources.get("Font")):
+        return True
+    if depth > 5:
+        # Deeply nested forms. Let layout analysis sort it out
+        return True
+    xobjects = resolve1(resources.get("XObject"))
+    if not isinstance(xobjects, dict):
+        return False
+    for xobject in xobjects.values():
+        xobject = resolve1(xobject)
+        if (isinstance(xobject, PDFStream) and
+           Stream(xobject).get("Subtype") == "form" and
+           "Resources" in xobject and
+           _has_fonts(xobject.get("Resources"), depth + 1)):
+            return True
+    return False
+
+
+def _has_images(resources):
+    """Return True if a PDF resource dictionary contains image XObjects.
+    """
+    resources = resolve1(resources)
+    if not isinstance(resources, dict):
+        return False
+    xobjects = resolve1(resources.get("XObject"))
+    if not isinstance(xobjects, dict):
+        return False
+    return any(Stream(resolve1(xobject)).get("Subtype") == "image"
+               for xobject in xobjects.values())
+
+
 class PdfMinerWrapper(object):
+    """An open PDF file. The cross reference table, catalog and info of
+       the file are parsed once, on `open()`, and then serve metadata,
+       page count, and pages, for as long as the file is open.
+
+       Use as a context manager, or call `open()` and `close()`.
+    """
+
+    PROBE_PAGES = 3
+    """Number of pages to look at, to tell if a file is scanned"""
 
     def __init__(self, filename):
         self.filename = filename
+        self.file_pointer = None
+        self.document = None
+        self._page_cursor = None
+        """(page number, page tree walk) of the last page from get_page"""
 
-    def __enter__(self):
+    def open(self):
+        """Open and parse the file, unless already done. Returns self.
+        """
+        if self.document is not None:
+            return self
         self.file_pointer = open(self.filename, "rb")
         try:
             self.parser = PDFParser(self.file_pointer)
             self.document = PDFDocument(self.parser)
         except PSEOF:
+            self.close()
             raise CompatibilityError("PdfMiner reported an unexpected EOF")
         except PDFSyntaxError:
+            self.close()
             raise CompatibilityError("PdfMiner reported a syntax error")
         except ValueError:
+            self.close()
             raise CompatibilityError("PdfMiner could not parse this file")
 
         if not self.document.is_extractable:
+            self.close()
             raise PDFTextExtractionNotAllowed
         self.parser.set_document(self.document)
         return self
 
-    def _get_next_page(self):
-        """Return the next page as a PDFPage object
+    def close(self):
+        if self.file_pointer is not None:
+            self.file_pointer.close()
+        self.file_pointer = None
+        self.document = None
+        self._page_cursor = None
+
+    def __enter__(self):
+        return self.open()
+
+    def get_metadata(self):
+        """Returns metadata from both
+           the info field (older PDFs) and XMP (newer PDFs).
+           Return format is a .modules.metadata.Metadata object
+        """
+        metadata = Metadata()
+
+        for i in self.document.info:
+            metadata.add(i)
+
+        if 'Metadata' in self.document.catalog:
+            catalog = self.document.catalog['Metadata']
+            xmp_metadata = resolve1(catalog).get_data()
+            xmp_dict = xmp_to_dict(xmp_metadata)
+            # Let's add only the most useful one
+            if "xap" in xmp_dict:
+                metadata.add(xmp_dict["xap"])
+            if "pdf" in xmp_dict:
+                metadata.add(xmp_dict["pdf"])
+            if "dc" in xmp_dict:
+                metadata.add(xmp_dict["dc"], metadataType="dc")
+        return metadata
+
+    def get_page_count(self):
+        """Return the number of pages, from the page tree root if
+           possible, without walking the tree.
         """
-        rsrcmgr = PDFResourceManager()
-        laparams = LAParams()
-        device = PDFPageAggregator(rsrcmgr, laparams=laparams)
-        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        pages = resolve1(self.document.catalog.get("Pages"))
+        if isinstance(pages, dict):
+            count = resolve1(pages.get("Count"))
+            if isinstance(count, int):
+                return count
+        return sum(1 for page in self._get_page_objects())
+
+    def is_image_only(self):
+        """Cheaply guess if this is a scanned file, by looking at the
+           resources of the first few pages: Image only pages have images,
+           but no fonts. No content streams are parsed.
+        """
+        probed = 0
+        for (page_number, page) in self._get_page_objects():
+            if _has_fonts(page.resources) or not _has_images(page.resources):
+                return False
+            probed += 1
+            if probed == self.PROBE_PAGES:
+                break
+        return probed > 0
 
+    def _get_page_objects(self):
+        """Yield (page number, PDFPage) for each page in the page tree.
+           PdfMiner raises TypeError on some broken page trees.
+        """
+        pages = PDFPage.create_pages(self.document)
         page_number = 0
-        for page in PDFPage.create_pages(self.document):
+        while True:
+            try:
+                page = next(pages)
+            except StopIteration:
+                return
+            except TypeError:
+                raise CompatibilityError("PdfMiner could not read the "
+                                         "page tree")
             page_number += 1
+            yield (page_number, page)
+
+    def _process_page(self, interpreter, device, page):
+        """Interpret a PDFPage, and return its layout. PdfMiner raises
+           TypeError on some broken content streams.
+        """
+        try:
             interpreter.process_page(page)
-            layout = device.get_result()
-            yield PdfPage(layout, page_number)
+            return device.get_result()
+        except TypeError:
+            raise CompatibilityError("PdfMiner could not interpret a page")
+
+    def get_next_page(self, temp_space=None, text_reader=None,
+                      first_page=1, last_page=None, header_only=False):
+        """Yield the pages of the file as PdfPage objects. Pages without
+           fonts are returned as PdfPageWithoutFonts, without layout
+           analysis. Only pages `first_page` to `last_page` (or to the
+           end) are analysed.
+
+           With `header_only`, only the header band of each page is
+           analysed (see HeaderBandAggregator). The text of such pages
+           is that of the header band only.
+
+           `temp_space` is where pages will put temporary files,
+           e.g. images for OCR.
+
+           `text_reader` is a pdfUtils.PdftotextReader for the same file,
+           if any. Pages it returns text for are yielded as PdftotextPage
+           objects, without layout analysis. Others are analysed as usual.
+        """
+        (device, interpreter) = self._get_interpreter(header_only)
+        for (page_number, page) in self._get_page_objects():
+            if page_number < first_page:
+                continue
+            if last_page is not None and page_number > last_page:
+                break
+            yield self._analyse_page(page_number, page, temp_space,
+                                     text_reader, device, interpreter)
+
+    def get_page(self, page_number, temp_space=None):
+        """Return a single page, analysed like get_next_page does, or None
+           if there is no such page. The page tree walk goes on from the
+           page last asked for, so asking for pages in order walks the
+           tree only once.
+        """
+        if self._page_cursor is None or self._page_cursor[0] >= page_number:
+            self._page_cursor = (0, self._get_page_objects())
+        pages = self._page_cursor[1]
+        for (number, page) in pages:
+            if number == page_number:
+                self._page_cursor = (number, pages)
+                (device, interpreter) = self._get_interpreter()
+                return self._analyse_page(page_number, page, temp_space,
+                                          None, device, interpreter)
+        self._page_cursor = None
+        return None
+
+    def _get_interpreter(self, header_only=False):
+        """Return a (device, interpreter) tuple for layout analysis"""
+        rsrcmgr = PDFResourceManager()
+        laparams = LAParams()
+        if header_only:
+            device = HeaderBandAggregator(rsrcmgr, laparams=laparams)
+        else:
+            device = PDFPageAggregator(rsrcmgr, laparams=laparams)
+        return (device, PDFPageInterpreter(rsrcmgr, device))
+
+    def _analyse_page(self, page_number, page, temp_space, text_reader,
+                      device, interpreter):
+        """Return a Page for a PDFPage. See get_next_page."""
+        if not _has_fonts(page.resources):
+            return PdfPageWithoutFonts(page_number, temp_space)
+        if text_reader is not None:
+            text_page = text_reader.get_page(page_number)
+            if text_page is not None:
+                text_page = PdftotextPage(page_number, *text_page)
+                if text_page.word_count() > 0:
+                    return text_page
+        layout = self._process_page(interpreter, device, page)
+        return PdfPage(layout, page_number, temp_space)
 
     def __iter__(self):
-        return iter(self._get_next_page())
+        return iter(self.get_next_page())
 
     def __exit__(self, _type, value, traceback):
-        self.file_pointer.close()
+        self.close()
+
+
+def _extract_page_range(args):
+    """Analyse the pages `first_page` to `last_page` (or to the end) of
+       a PDF file, in a process of its own. Returns a list of
+       (page number, text, header, date), where text, header and date
+       are None for pages that need OCR.
+    """
+    (path, first_page, last_page) = args
+    text_reader = None
+    if get_pdf_text_engine() == "pdftotext":
+        try:
+            text_reader = PdftotextReader(path, first_page, last_page)
+        except CompatibilityError:
+            logging.warning("Could not start pdftotext. Using PdfMiner.")
+    records = []
+    try:
+        with PdfMinerWrapper(path) as document:
+            for page in document.get_next_page(None, text_reader,
+                                               first_page, last_page):
+                if page.word_count() == 0:
+                    records.append((page.page_number, None, None, None))
+                else:
+                    records.append((page.page_number,
+                                    page.get_text(),
+                                    page.get_header(),
+                                    page.get_date()))
+    finally:
+        if text_reader is not None:
+            text_reader.close()
+    return records
 
 
 class PdfExtractor(ExtractorBase):
     """Class for getting plain text from a PDF file.
     """
 
+    version = 2
+
+    header_only = False
+    """See PdfHeaderExtractor"""
+
+    _session = None
+    _pages = None
+    """Pages produced so far, shared by all calls to get_next_page"""
+    _page_producer = None
+
+    def get_session(self):
+        """Return the open PdfMinerWrapper for this file. The file is
+           parsed once, and then kept open until close().
+        """
+        if self._session is None:
+            self._session = PdfMinerWrapper(self.path)
+        return self._session.open()
+
     def get_metadata(self):
         """Returns metadata from both
            the info field (older PDFs) and XMP (newer PDFs).
            Return format is a .modules.metadata.Metadata object
         """
-        with PdfMinerWrapper(self.path) as pdf_miner:
-            metadata = Metadata()
+        self.metadata = self.get_session().get_metadata()
+        return self.metadata
+
+    def get_page_count(self):
+        return self.get_session().get_page_count()
+
+    def is_streaming(self):
+        """Return True if pages should be reduced to their text, header
+           and date as soon as they are parsed, rather than keep their
+           layout. Memory use then stays flat in the number of pages.
+           See `settings.pdf_streaming_min_pages`.
+        """
+        min_pages = getattr(settings, "pdf_streaming_min_pages",
+                            STREAMING_MIN_PAGES)
+        if min_pages is None:
+            return False
+        return self.get_page_count() >= min_pages
+
+    def get_cache_settings(self):
+        """The text engine and OCR settings decide what text we get"""
+        return (get_pdf_text_engine(), get_ocr_resolutions(),
+                self.header_only or ocr_header_first())
+
+    def get_range_processes(self):
+        """Return the number of processes to analyse the pages of this
+           file in, in ranges. 1 means pages are analysed here, in order.
+           See `settings.pdf_range_processes`.
+        """
+        from multiprocessing import current_process
+        processes = getattr(settings, "pdf_range_processes", 1)
+        if processes <= 1:
+            return 1
+        min_pages = getattr(settings, "pdf_range_min_pages", RANGE_MIN_PAGES)
+        if self.get_page_count() < min_pages:
+            return 1
+        if current_process().daemon:
+            logging.warning("Can not start page range processes from a "
+                            "daemonic process. Analysing pages in order.")
+            return 1
+        return processes
 
-            for i in pdf_miner.document.info:
-                metadata.add(i)
+    def _get_pages_in_ranges(self, processes, temp_space):
+        """Analyse the pages of this file in page ranges, in `processes`
+           processes, that each open the file on their own. Yields pages
+           in order. Pages that need OCR are yielded as
+           PdfPageWithoutFonts, and left to the caller.
+        """
+        from multiprocessing import Pool
+        page_count = self.get_page_count()
+        size = max(1, -(-page_count // (processes * RANGES_PER_PROCESS)))
+        ranges = [(self.path, first, first + size - 1)
+                  for first in range(1, page_count + 1, size)]
+        # The page count can be wrong in broken files. Take any pages
+        # after it with the last range
+        ranges[-1] = (self.path, ranges[-1][1], None)
 
-            if 'Metadata' in pdf_miner.document.catalog:
-                catalog = pdf_miner.document.catalog['Metadata']
-                xmp_metadata = resolve1(catalog).get_data()
-                xmp_dict = xmp_to_dict(xmp_metadata)
-                # Let's add only the most useful one
-                if "xap" in xmp_dict:
-                    metadata.add(xmp_dict["xap"])
-                if "pdf" in xmp_dict:
-                    metadata.add(xmp_dict["pdf"])
-                if "dc" in xmp_dict:
-                    metadata.add(xmp_dict["dc"], metadataType="dc")
+        logging.info("Analysing %d pages in %d ranges, in %d processes." %
+                     (page_count, len(ranges), processes))
+        pool = Pool(processes=processes)
+        completed = False
+        try:
+            for records in pool.imap(_extract_page_range, ranges):
+                for (page_number, text, header, date) in records:
+                    if text is None:
+                        yield PdfPageWithoutFonts(page_number, temp_space)
+                    else:
+                        yield CachedPage(page_number, text, header, date)
+            completed = True
+        finally:
+            if completed:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
 
-            self.metadata = metadata
-            return metadata
+    def _get_renderer(self, renderer, page_number, last_ocr_page):
+        """Return a PageRenderer for `page_number`, reusing `renderer`
+           if it has that page coming next. A page after an OCR:ed page
+           starts a renderer for all remaining pages, as scanned pages
+           tend to come in runs. Others get a renderer of their own,
+           not to render pages that have text.
+        """
+        if renderer is not None:
+            if (renderer.can_render(page_number) and
+               renderer.next_page == page_number):
+                return renderer
+            renderer.close()
+        resolution = get_ocr_resolutions()[0]
+        if last_ocr_page == page_number - 1:
+            return PageRenderer(self.path, page_number,
+                                resolution=resolution)
+        return PageRenderer(self.path, page_number, page_number,
+                            resolution=resolution)
 
+    @cached_pages
     def get_next_page(self):
         """Returns the next Page object, representing a page in the PDF
            Will do OCR if needed.
+
+           The file is parsed only once. Calls made while another call
+           is still iterating, e.g. from get_date, share its pages, and
+           parse further pages as needed.
         """
-        try:
-            for page in self._page_cache:
-                yield page
-        except AttributeError:  # not cached
-            pass
+        if self._pages is None:
+            self._pages = []
+            self._page_producer = self._produce_pages()
+        i = 0
+        while True:
+            if i < len(self._pages):
+                yield self._pages[i]
+                i += 1
+                continue
+            if self._page_producer is None:
+                # All pages parsed
+                return
+            try:
+                page = next(self._page_producer)
+            except StopIteration:
+                self._page_producer = None
+                return
+            except:
+                # Do not leave a broken producer for the next caller
+                self._page_producer = None
+                raise
+            self._pages.append(page)
+
+    def _produce_pages(self):
+        """Parse the file, and yield its pages in order.
+        """
+        temp_space = self.get_temp_space()
+        renderer = None
+        last_ocr_page = None
+        text_reader = None
+        pages = None
+        ocr_pages = 0
+        max_ocr_pages = getattr(settings, "extraction_max_ocr_pages", None)
+        header_first = self.header_only or ocr_header_first()
 
-        self._page_cache = []
+        # With more than one OCR thread, parse and OCR a few pages ahead,
+        # while the first ones are being OCR:ed. Pages are still yielded
+        # in order.
+        ocr_threads = get_ocr_service().threads
+        lookahead = 2 * ocr_threads if ocr_threads > 1 else 0
+        pending = deque()
         try:
-            with PdfMinerWrapper(self.path) as document:
-                for page in document:
-                    if page.word_count() == 0:
-                        logging.info("No text, doing OCR.")
-                        ocr_page = PdfPageFromOcr(self.path, page.page_number)
-                        self._page_cache.append(ocr_page)
-                        yield ocr_page
-                    else:
-                        self._page_cache.append(page)
-                        yield page
+            document = self.get_session()
+            streaming = self.is_streaming()
+            if streaming:
+                logging.info("Large file, keeping only text of pages.")
+            if document.is_image_only():
+                # Render all pages in one go, from the start
+                logging.info("Scanned file, doing OCR on all pages.")
+                renderer = self._get_renderer(None, 1, 0)
+                processes = 1
+            else:
+                processes = self.get_range_processes()
+            if processes > 1:
+                pages = self._get_pages_in_ranges(processes, temp_space)
+            else:
+                if get_pdf_text_engine() == "pdftotext":
+                    try:
+                        text_reader = PdftotextReader(self.path)
+                    except CompatibilityError:
+                        logging.warning("Could not start pdftotext. "
+                                        "Using PdfMiner.")
+                pages = document.get_next_page(temp_space, text_reader,
+                                               header_only=self.header_only)
+            for page in pages:
+                if self.header_only and isinstance(page, PdfPage):
+                    # Text outside the header band is not known yet
+                    needs_ocr = isinstance(page, PdfPageWithoutFonts)
+                else:
+                    needs_ocr = page.word_count() == 0
+                if needs_ocr:
+                    logging.info("No text, doing OCR.")
+                    ocr_pages += 1
+                    if max_ocr_pages is not None and ocr_pages > max_ocr_pages:
+                        raise ExtractionBudgetExceeded(
+                            "More than %d pages need OCR" % max_ocr_pages)
+                    renderer = self._get_renderer(renderer,
+                                                  page.page_number,
+                                                  last_ocr_page)
+                    last_ocr_page = page.page_number
+                    page = PdfPageFromOcr(self.path,
+                                          page.page_number,
+                                          temp_space,
+                                          renderer,
+                                          in_background=lookahead > 0,
+                                          header_first=header_first)
+                elif self.header_only and isinstance(page, PdfPage):
+                    page = CachedPage(page.page_number,
+                                      None,
+                                      page.get_header(),
+                                      page.get_date(),
+                                      text_loader=self.get_page_text)
+                elif streaming and processes == 1:
+                    # Release the layout tree. Pages from page range
+                    # processes have none
+                    page = page.compact()
+                pending.append(page)
+                while len(pending) > lookahead:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
         except PDFTextExtractionNotAllowed:
             # Simply not allowed
             raise ExtractionNotAllowed
@@ -329,8 +995,56 @@ class PdfExtractor(ExtractorBase):
             # I have actually no idea what going on here,
             # but this error occurs in some protected PDF's
             raise ExtractionNotAllowed
-        except TypeError:
-            raise CompatibilityError
+        finally:
+            if pages is not None:
+                # Stops page range processes, if any
+                pages.close()
+            if renderer is not None:
+                renderer.close()
+            if text_reader is not None:
+                text_reader.close()
+
+    def get_page_text(self, page_number):
+        """Return the text of a single page, from a full analysis of it,
+           or from OCR if it has no text. Used for cached pages, and
+           header only pages, whose text was not needed at first.
+        """
+        temp_space = self.get_temp_space()
+        page = self.get_session().get_page(page_number, temp_space)
+        if page is not None and page.word_count() > 0:
+            return page.get_text()
+        # The text is what is needed, so skip the header band
+        page = PdfPageFromOcr(self.path, page_number, temp_space,
+                              header_first=False)
+        return page.get_text()
+
+    def close(self):
+        if self._page_producer is not None:
+            # Stop renderers and readers of an unfinished parse
+            self._page_producer.close()
+            self._page_producer = None
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        super(PdfExtractor, self).close()
+
+    @cached_value("date")
+    def get_date(self):
+        """Return the most common date in the text of the file. Pages
+           that have not been fully OCR:ed contribute only their headers,
+           not to OCR pages that will not be stored.
+
+           The date is computed once (see cached_value), as DocumentList
+           asks for it for every page without a date of its own.
+        """
+        texts = []
+        for page in self.get_next_page():
+            if page.is_text_done():
+                texts.append(page.get_text())
+            else:
+                texts.append(page.get_header())
+        return get_date_from_text(u"\n".join(make_unicode(text)
+                                              for text in texts))
 
     def get_text(self):
         """Returns all text content from the PDF as plain text.
@@ -352,6 +1066,23 @@ class PdfExtractor(ExtractorBase):
 
         return self._text_cache
 
+
+class PdfHeaderExtractor(PdfExtractor):
+    """A PdfExtractor that analyses only the header band of each page
+       (scanned pages get only their header band OCR:ed), for cheap
+       classification of pages into documents, e.g.
+
+           document_list = DocumentList(PdfHeaderExtractor(path))
+
+       The text of a page is analysed, or OCR:ed, only if asked for.
+    """
+
+    header_only = True
+
+    def get_range_processes(self):
+        """Header bands are cheap enough to analyse in order"""
+        return 1
+
 if __name__ == "__main__":
     print "This module is only intended to be called from other scripts."
     import sys
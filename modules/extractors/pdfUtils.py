@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
-"""Various helper methods for PDF extraction.
+"""Various helper methods for PDF extraction: decoding embedded images
+   for OCR (`decode_image`), rendering pages with Ghostscript
+   (`PageRenderer`), and reading page text with pdftotext
+   (`PdftotextReader`).
 """
 
-# This file contains mostly unused leftovers from pdf.py.
+import os
+import struct
+import logging
+import subprocess
+from io import BytesIO
+
+from modules.extractors.documentBase import CompatibilityError
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
 
 
 class Stream (object):
@@ -20,6 +31,324 @@ class Stream (object):
         except Exception:
             return None
 
+
+DCT_FILTERS = ["dctdecode", "dct"]
+CCITT_FILTERS = ["ccittfaxdecode", "ccf"]
+DECODED_FILTERS = ["flatedecode", "fl", "lzwdecode", "lzw",
+                   "ascii85decode", "a85", "asciihexdecode", "ahx",
+                   "runlengthdecode", "rl"]
+"""Filters that PdfMiner's get_data() decodes"""
+
+
+def _get_name(value):
+    """Return a PDF name as a lower case string, like Stream.get"""
+    return str(value).strip("/_").lower()
+
+
+def _get_attribute(stream, *names):
+    """Return the first of `names` (e.g. a full and an abbreviated
+       name) present in a PDF stream, resolved.
+    """
+    from pdfminer.pdftypes import resolve1
+    for name in names:
+        if name in stream:
+            return resolve1(stream[name])
+    return None
+
+
+def _get_color_mode(stream, bits):
+    """Return a PIL mode for the raw samples of an image stream, or None
+       for colour spaces we do not handle (e.g. Indexed).
+    """
+    from pdfminer.pdftypes import resolve1
+    if _get_attribute(stream, "ImageMask", "IM"):
+        return "1"
+    color_space = _get_attribute(stream, "ColorSpace", "CS")
+    if isinstance(color_space, list):
+        family = _get_name(color_space[0])
+        if family == "iccbased":
+            components = resolve1(color_space[1]).get("N")
+            family = {1: "devicegray", 3: "devicergb",
+                      4: "devicecmyk"}.get(components)
+    else:
+        family = _get_name(color_space)
+    if family in ("devicegray", "g", "calgray") and bits == 1:
+        return "1"
+    if bits != 8:
+        return None
+    return {"devicegray": "L", "g": "L", "calgray": "L",
+            "devicergb": "RGB", "rgb": "RGB", "calrgb": "RGB",
+            "devicecmyk": "CMYK", "cmyk": "CMYK"}.get(family)
+
+
+def _ccitt_to_tiff(data, width, height):
+    """Wrap CCITT Group 4 data in a minimal TIFF file, that PIL can read.
+    """
+    entries = [
+        (256, 4, 1, width),  # ImageWidth
+        (257, 4, 1, height),  # ImageLength
+        (258, 3, 1, 1),  # BitsPerSample
+        (259, 3, 1, 4),  # Compression: CCITT Group 4
+        (262, 3, 1, 0),  # PhotometricInterpretation: WhiteIsZero
+        (273, 4, 1, 0),  # StripOffsets, set below
+        (278, 4, 1, height),  # RowsPerStrip
+        (279, 4, 1, len(data)),  # StripByteCounts
+    ]
+    data_offset = 8 + 2 + 12 * len(entries) + 4
+    entries[5] = (273, 4, 1, data_offset)
+    header = struct.pack("<2sHL", "II", 42, 8)
+    ifd = struct.pack("<H", len(entries))
+    for entry in entries:
+        ifd += struct.pack("<HHLL", *entry)
+    ifd += struct.pack("<L", 0)
+    return header + ifd + data
+
+
+def decode_image(stream):
+    """Decode a PdfMiner image stream to a PIL Image, in memory.
+       Handles JPEG (DCT) images, CCITT Group 4 faxes, and raw samples
+       in the filters PdfMiner can decode (e.g. Flate). Returns None
+       for anything else, e.g. indexed colours, JBIG2 or JPEG 2000.
+    """
+    from PIL import Image, ImageOps
+    from pdfminer.pdftypes import resolve1
+
+    filters = [_get_name(f) for f in stream.get_filters()]
+    width = _get_attribute(stream, "Width", "W")
+    height = _get_attribute(stream, "Height", "H")
+    try:
+        if filters and filters[-1] in DCT_FILTERS:
+            # PdfMiner leaves the JPEG data as it is
+            image = Image.open(BytesIO(stream.get_data()))
+            image.load()
+            return image
+
+        if len(filters) == 1 and filters[0] in CCITT_FILTERS:
+            params = _get_attribute(stream, "DecodeParms", "DP") or {}
+            if isinstance(params, list):
+                params = resolve1(params[0]) or {}
+            if resolve1(params.get("K", 0)) >= 0:
+                # Group 3 comes in too many flavours
+                return None
+            width = resolve1(params.get("Columns", 1728))
+            height = resolve1(params.get("Rows", height))
+            image = Image.open(BytesIO(_ccitt_to_tiff(stream.get_rawdata(),
+                                                      width, height)))
+            image.load()
+            return image
+
+        if not all(f in DECODED_FILTERS for f in filters):
+            return None
+        bits = _get_attribute(stream, "BitsPerComponent", "BPC") or 1
+        mode = _get_color_mode(stream, bits)
+        if mode is None:
+            return None
+        image = Image.frombytes(mode, (width, height), stream.get_data())
+        decode = _get_attribute(stream, "Decode", "D")
+        if mode in ("1", "L") and decode and resolve1(decode[0]) == 1:
+            image = ImageOps.invert(image.convert("L"))
+        return image
+    except Exception:
+        # Broken or unexpected image data. Let the caller try other means
+        return None
+
+
+class PageRenderer(object):
+    """Renders pages from a PDF file to images, with one Ghostscript
+       process for a whole range of pages. Ghostscript writes the pages
+       to a pipe, as PNG images, and each image is read as soon as it is
+       complete, so that OCR can start on the first page while the next
+       ones are rendered.
+
+       Pages must be requested in ascending order. Pages skipped over
+       are rendered, but thrown away.
+    """
+
+    def __init__(self, pdf_path, first_page, last_page=None, resolution=600):
+        """Render pages `first_page` to `last_page`, or to the end of
+           the file if `last_page` is None.
+        """
+        self.pdf_path = pdf_path
+        self.first_page = first_page
+        self.last_page = last_page
+        self.resolution = resolution
+        self.next_page = first_page
+        """Number of the next page to be read from Ghostscript"""
+
+        arglist = ["gs",
+                   "-dSAFE",
+                   "-dQUIET",
+                   "-dBATCH",
+                   "-dNOPAUSE",
+                   "-sstdout=%stderr",  # keep the pipe for images
+                   "-sOutputFile=-",
+                   "-sDEVICE=pnggray",
+                   "-r%d" % resolution,
+                   "-dFirstPage=%d" % first_page]
+        if last_page is not None:
+            arglist.append("-dLastPage=%d" % last_page)
+        arglist.append(pdf_path)
+        try:
+            with open(os.devnull, "w") as devnull:
+                self._process = subprocess.Popen(arglist,
+                                                 stdout=subprocess.PIPE,
+                                                 stderr=devnull)
+        except OSError as e:
+            logging.error("Failed to run GhostScript." +
+                          "I/O error({0}): {1}".format(e.errno, e.strerror))
+            raise CompatibilityError("Could not start GhostScript")
+
+    def can_render(self, page_number):
+        """Return True if `page_number` is still to come from this
+           renderer.
+        """
+        return (self._process is not None and
+                page_number >= self.next_page and
+                (self.last_page is None or page_number <= self.last_page))
+
+    def _read(self, length):
+        data = self._process.stdout.read(length)
+        if len(data) < length:
+            raise CompatibilityError("GhostScript could not render page %d"
+                                     " of %s" % (self.next_page,
+                                                 self.pdf_path))
+        return data
+
+    def _read_png(self):
+        """Read one PNG image from the pipe, and return it as a string.
+        """
+        chunks = [self._read(len(PNG_SIGNATURE))]
+        if chunks[0] != PNG_SIGNATURE:
+            raise CompatibilityError("Unexpected output from GhostScript")
+        while True:
+            header = self._read(8)
+            (length, chunk_type) = struct.unpack(">I4s", header)
+            chunks.append(header)
+            # Chunk data, and a 4 byte CRC
+            chunks.append(self._read(length + 4))
+            if chunk_type == "IEND":
+                break
+        self.next_page += 1
+        return "".join(chunks)
+
+    def get_image(self, page_number):
+        """Return page `page_number` as a PIL Image.
+        """
+        from PIL import Image
+        if not self.can_render(page_number):
+            raise ValueError("Page %d can not be rendered anymore"
+                             % page_number)
+        try:
+            while self.next_page < page_number:
+                self._read_png()
+            png = self._read_png()
+        except CompatibilityError:
+            self.close()
+            raise
+        return Image.open(BytesIO(png))
+
+    def close(self):
+        """Stop Ghostscript, if it is still running.
+        """
+        if self._process is None:
+            return
+        self._process.stdout.close()
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process = None
+
+
+class PdftotextReader(object):
+    """Reads the words of a PDF file, and their positions, page by page,
+       with poppler's `pdftotext -bbox`. Output is parsed as it comes,
+       so that only one page at a time is held in memory.
+
+       Pages must be requested in ascending order.
+    """
+
+    def __init__(self, pdf_path, first_page=1, last_page=None):
+        """Read pages `first_page` to `last_page`, or to the end of
+           the file if `last_page` is None.
+        """
+        self.pdf_path = pdf_path
+        self.next_page = first_page
+        """Number of the next page to be read from pdftotext"""
+
+        arglist = ["pdftotext",
+                   "-bbox",
+                   "-enc", "UTF-8",
+                   "-f", str(first_page)]
+        if last_page is not None:
+            arglist += ["-l", str(last_page)]
+        arglist += [pdf_path, "-"]
+        try:
+            with open(os.devnull, "w") as devnull:
+                self._process = subprocess.Popen(arglist,
+                                                 stdout=subprocess.PIPE,
+                                                 stderr=devnull)
+        except OSError as e:
+            logging.error("Failed to run pdftotext." +
+                          "I/O error({0}): {1}".format(e.errno, e.strerror))
+            raise CompatibilityError("Could not start pdftotext")
+        from xml.etree.cElementTree import iterparse
+        self._events = iterparse(self._process.stdout, events=("end",))
+
+    def get_page(self, page_number):
+        """Return a tuple (width, height, words) for page `page_number`,
+           where words is a list of (x0, y0, x1, y1, text), with y
+           counted from the top of the page. Returns None if pdftotext
+           failed before reaching the page.
+        """
+        if self._process is None or page_number < self.next_page:
+            return None
+        try:
+            while True:
+                page = self._read_page()
+                if page is None:
+                    # End of file
+                    self.close()
+                    return None
+                self.next_page += 1
+                if self.next_page > page_number:
+                    return page
+        except SyntaxError as e:
+            # Truncated or malformed output
+            logging.warning("pdftotext failed on page %d of %s: %s" %
+                            (self.next_page, self.pdf_path, e))
+            self.close()
+            return None
+
+    def _read_page(self):
+        for (event, element) in self._events:
+            if not element.tag.endswith("page"):
+                continue
+            words = [(float(word.get("xMin")),
+                      float(word.get("yMin")),
+                      float(word.get("xMax")),
+                      float(word.get("yMax")),
+                      word.text or u"")
+                     for word in element
+                     if word.tag.endswith("word")]
+            page = (float(element.get("width")),
+                    float(element.get("height")),
+                    words)
+            element.clear()
+            return page
+        return None
+
+    def close(self):
+        """Stop pdftotext, if it is still running.
+        """
+        if self._process is None:
+            return
+        self._process.stdout.close()
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process = None
+
+# Unused leftovers from pdf.py, kept for reference.
 """
 from pdfminer.pdftypes import resolve1, PDFObjRef
 from binascii import b2a_hex
@@ -34,7 +34,7 @@ class RtfExtractor(DocExtractor):
            for RTF metadata specification
         """
         import os
-        temp_filename = os.path.join("temp", "tmp.rtf.xml")
+        temp_filename = self.get_temp_space().get_path("tmp.rtf.xml")
 
         parse_obj = rtf2xml.ParseRtf.ParseRtf(in_file=self.path,
                                               out_file=temp_filename)
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""This module contains image preprocessing steps, applied to images
+   before they are handed to Tesseract, so that it has fewer pixels to
+   process. Steps are listed in `settings.ocr_preprocessing`:
+
+    * "trim": crop away blank margins.
+    * "deskew": straighten slightly rotated scans.
+    * "downscale": shrink images wider than `settings.ocr_max_width`.
+    * "binarize": threshold the image to black and white, using Otsu's
+      method.
+
+   Steps always run in the order above. All of them need numpy, and
+   are skipped if it is not installed.
+"""
+
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import settings
+
+STEPS = ["trim", "deskew", "downscale", "binarize"]
+"""All available steps, in the order they are applied"""
+
+DEFAULT_MAX_WIDTH = 3000
+"""Default for settings.ocr_max_width, a little above an A4 page at
+   300 dpi.
+"""
+
+TRIM_PADDING = 20
+"""Pixels of blank margin to keep around the content"""
+
+DARK = 128
+"""Gray levels below this count as ink, when trimming and deskewing"""
+
+SKEW_ANGLES = [a * 0.25 for a in range(-12, 13)]
+"""Angles, in degrees, to try when deskewing"""
+
+SKEW_PROBE_WIDTH = 600
+"""Width of the thumbnail that skew is measured on"""
+
+
+def get_steps():
+    """Return the preprocessing steps in `settings.ocr_preprocessing`,
+       in the order they are applied. Returns an empty list if numpy is
+       not installed.
+    """
+    steps = getattr(settings, "ocr_preprocessing", None) or []
+    for step in steps:
+        if step not in STEPS:
+            raise ValueError("Unknown OCR preprocessing step: %s" % step)
+    if steps and numpy is None:
+        logging.warning("numpy is not installed. Skipping OCR preprocessing")
+        return []
+    return [step for step in STEPS if step in steps]
+
+
+def get_settings_key(steps):
+    """Return a string that changes with `steps`, and with any settings
+       they use, for cache keys.
+    """
+    parts = list(steps)
+    if "downscale" in steps:
+        parts.append(str(getattr(settings, "ocr_max_width",
+                                 DEFAULT_MAX_WIDTH)))
+    return ",".join(parts)
+
+
+def get_otsu_threshold(pixels):
+    """Return the gray level that best separates ink from paper, in an
+       8 bit numpy array, using Otsu's method.
+    """
+    histogram = numpy.bincount(pixels.ravel(), minlength=256)
+    histogram = histogram.astype(numpy.float64)
+    levels = numpy.arange(256)
+    weight_bg = numpy.cumsum(histogram)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = numpy.cumsum(histogram * levels)
+    sum_all = sum_bg[-1]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / weight_fg
+        variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    variance = numpy.nan_to_num(variance)
+    return int(numpy.argmax(variance))
+
+
+def binarize(image):
+    pixels = numpy.asarray(image, dtype=numpy.uint8)
+    threshold = get_otsu_threshold(pixels)
+    pixels = numpy.where(pixels > threshold, 255, 0).astype(numpy.uint8)
+    return _from_array(pixels)
+
+
+def trim(image):
+    pixels = numpy.asarray(image, dtype=numpy.uint8) < DARK
+    rows = numpy.flatnonzero(pixels.any(axis=1))
+    columns = numpy.flatnonzero(pixels.any(axis=0))
+    if not len(rows):
+        # Blank page. Leave it to Tesseract
+        return image
+    (width, height) = image.size
+    box = (max(int(columns[0]) - TRIM_PADDING, 0),
+           max(int(rows[0]) - TRIM_PADDING, 0),
+           min(int(columns[-1]) + 1 + TRIM_PADDING, width),
+           min(int(rows[-1]) + 1 + TRIM_PADDING, height))
+    return image.crop(box)
+
+
+def get_skew(image):
+    """Return the angle, in degrees, that `image` should be rotated by
+       to make its lines of text horizontal. Lines are straight when
+       ink is concentrated in few rows, i.e. when the row sums of ink
+       vary the most.
+    """
+    from PIL import Image
+    (width, height) = image.size
+    if width > SKEW_PROBE_WIDTH:
+        thumbnail = image.resize((SKEW_PROBE_WIDTH,
+                                  height * SKEW_PROBE_WIDTH // width),
+                                 Image.BILINEAR)
+    else:
+        thumbnail = image
+    best_angle = 0
+    best_score = None
+    for angle in SKEW_ANGLES:
+        rotated = _rotate(thumbnail, angle)
+        ink = numpy.asarray(rotated, dtype=numpy.uint8) < DARK
+        score = numpy.var(ink.sum(axis=1))
+        if best_score is None or score > best_score:
+            (best_angle, best_score) = (angle, score)
+    return best_angle
+
+
+def deskew(image):
+    angle = get_skew(image)
+    if angle == 0:
+        return image
+    return _rotate(image, angle)
+
+
+def downscale(image):
+    from PIL import Image
+    max_width = getattr(settings, "ocr_max_width", DEFAULT_MAX_WIDTH)
+    (width, height) = image.size
+    if width <= max_width:
+        return image
+    return image.resize((max_width, height * max_width // width),
+                        Image.ANTIALIAS)
+
+
+def _from_array(pixels):
+    from PIL import Image
+    return Image.fromarray(pixels, "L")
+
+
+def _rotate(image, angle):
+    """Rotate a grayscale image, filling the corners with white"""
+    from PIL import Image
+    (width, height) = image.size
+    rotated = image.rotate(angle, Image.BILINEAR, expand=False)
+    # Older PIL versions have no fill color. Paint corners white
+    mask = Image.new("L", (width, height), 255).rotate(angle, expand=False)
+    white = Image.new("L", (width, height), 255)
+    return Image.composite(rotated, white, mask)
+
+
+def preprocess(image, steps):
+    """Apply `steps` (see get_steps) to `image`, a PIL Image, and return
+       a grayscale image.
+    """
+    if not steps:
+        return image
+    if image.mode != "L":
+        image = image.convert("L")
+    functions = {
+        "trim": trim,
+        "deskew": deskew,
+        "downscale": downscale,
+        "binarize": binarize,
+    }
+    for step in steps:
+        image = functions[step](image)
+    return image
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""This module contains the OCR service used by extractors. Use
+   `get_ocr_service` to get the service for the current process:
+
+       text = get_ocr_service().image_to_string(image)
+
+   If tesserocr (Python bindings for the Tesseract C API) is installed,
+   the service keeps a number of Tesseract engines warm, and hands images
+   to them in memory, so that language data is loaded only once per
+   engine. Otherwise, it falls back to pytesseract, that starts a new
+   `tesseract` process for each image.
+
+   `apply_async` runs OCR jobs in a pool of `settings.ocr_threads`
+   threads, so that the pages of a scanned file can be OCR:ed in
+   parallel. Both tesserocr and the tesseract process let other threads
+   run meanwhile.
+
+   The number of engines per process is set by `settings.ocr_engines`,
+   and defaults to the number of threads.
+
+   OCR results are cached by image content, as the same logos and
+   letterheads recur on every page of a file, and in every file from
+   the same municipality. Recent results are kept in memory, and all
+   results in the disk cache at `settings.ocr_cache_dir`, if set.
+
+   Images are preprocessed (see modules/imageprep.py) before OCR, if
+   `settings.ocr_preprocessing` is set. Results are cached by the image
+   as given, and the preprocessing settings, so that cache hits are not
+   preprocessed.
+"""
+
+import os
+import threading
+from hashlib import md5
+from Queue import Queue, Empty
+from collections import OrderedDict
+
+import settings
+from modules.cache import get_ocr_cache
+from modules import imageprep
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+DEFAULT_LANGUAGE = "swe"
+
+MEMORY_CACHE_SIZE = 1000
+"""Number of OCR results to keep in memory, in each process"""
+
+
+class OcrService(object):
+    """Hands out images to a pool of Tesseract engines. Engines are
+       created when first needed, up to `max_engines` per language.
+       Thread safe: each engine is used by one thread at a time.
+    """
+
+    cache_version = 3
+    """Increase when the format of cached results changes.
+       Results are (text, confidence) tuples.
+    """
+
+    def __init__(self, max_engines=1, threads=1, cache=None,
+                 preprocessing=None):
+        """`cache` is a cache.DiskCache for OCR results, if any.
+           `preprocessing` is a list of imageprep steps.
+        """
+        self.max_engines = max_engines
+        self.threads = threads
+        self.cache = cache
+        self.preprocessing = preprocessing or []
+        self._memory_cache = OrderedDict()
+        self._pool = None
+        self._engines = {}
+        """Idle engines, language => Queue"""
+        self._num_engines = {}
+        self._lock = threading.Lock()
+
+    def _get_engine(self, lang):
+        with self._lock:
+            if lang not in self._engines:
+                self._engines[lang] = Queue()
+                self._num_engines[lang] = 0
+            engines = self._engines[lang]
+            try:
+                return engines.get_nowait()
+            except Empty:
+                pass
+            if self._num_engines[lang] < self.max_engines:
+                self._num_engines[lang] += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return tesserocr.PyTessBaseAPI(lang=lang)
+            except Exception:
+                with self._lock:
+                    self._num_engines[lang] -= 1
+                raise
+        # Wait for another thread to finish with its engine
+        return engines.get()
+
+    def _release_engine(self, lang, engine):
+        self._engines[lang].put(engine)
+
+    def _get_cache_key(self, image, lang):
+        """Key on the image as given, and the preprocessing settings, so
+           that cache hits need no preprocessing.
+        """
+        engine = "pytesseract" if tesserocr is None else "tesserocr"
+        hash_ = md5("|".join([str(self.cache_version), engine, lang,
+                              imageprep.get_settings_key(self.preprocessing),
+                              image.mode, repr(image.size)]))
+        hash_.update(image.tobytes())
+        return hash_.hexdigest()
+
+    def _get_cached(self, key):
+        with self._lock:
+            if key in self._memory_cache:
+                # Move to the end, as most recently used
+                result = self._memory_cache.pop(key)
+                self._memory_cache[key] = result
+                return result
+        if self.cache is not None:
+            return self.cache.get(key)
+        return None
+
+    def _set_cached(self, key, result):
+        with self._lock:
+            self._memory_cache[key] = result
+            if len(self._memory_cache) > MEMORY_CACHE_SIZE:
+                self._memory_cache.popitem(last=False)
+        if self.cache is not None:
+            self.cache.put(key, result)
+
+    def image_to_string(self, image, lang=DEFAULT_LANGUAGE):
+        """Return the text in `image`, a PIL Image, as unicode.
+           Images that have been OCR:ed before are looked up in the cache.
+        """
+        return self.image_to_string_with_confidence(image, lang)[0]
+
+    def image_to_string_with_confidence(self, image, lang=DEFAULT_LANGUAGE):
+        """Return a tuple (text, confidence), where confidence is the mean
+           word confidence reported by Tesseract, 0-100, or None if not
+           available (pytesseract without `image_to_data`).
+        """
+        key = self._get_cache_key(image, lang)
+        result = self._get_cached(key)
+        if result is None:
+            image = imageprep.preprocess(image, self.preprocessing)
+            result = self._do_ocr(image, lang)
+            self._set_cached(key, result)
+        return result
+
+    def _do_ocr(self, image, lang):
+        if tesserocr is None:
+            import pytesseract
+            if hasattr(pytesseract, "image_to_data"):
+                # Text and confidence from one tesseract process
+                data = pytesseract.image_to_data(image, lang=lang)
+                return _parse_tsv(data.decode("utf-8"))
+            text = pytesseract.image_to_string(image, lang=lang)
+            return (text.decode("utf-8"), None)
+
+        engine = self._get_engine(lang)
+        try:
+            engine.SetImage(image)
+            text = engine.GetUTF8Text()
+            confidence = engine.MeanTextConf()
+            return (text, confidence)
+        finally:
+            engine.Clear()
+            self._release_engine(lang, engine)
+
+    def apply_async(self, function, args=()):
+        """Run `function` in the OCR thread pool, and return at once.
+           Call `get()` on the returned object to wait for the result.
+        """
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.threads)
+        return self._pool.apply_async(function, args)
+
+    def close(self):
+        """Stop the thread pool, and shut down all idle engines.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        with self._lock:
+            for (lang, engines) in self._engines.items():
+                while True:
+                    try:
+                        engine = engines.get_nowait()
+                    except Empty:
+                        break
+                    engine.End()
+                    self._num_engines[lang] -= 1
+
+
+def _parse_tsv(data):
+    """Return a tuple (text, confidence) from Tesseract TSV output, where
+       confidence is the mean word confidence, or None if there are no
+       words. Words are joined by spaces, lines by line breaks, and
+       paragraphs by empty lines, like Tesseract's plain text output.
+    """
+    parts = []
+    confidences = []
+    last_line = None
+    for row in data.splitlines()[1:]:
+        row = row.split(u"\t")
+        if len(row) != 12 or not row[11].strip():
+            # Not a word
+            continue
+        # Block, paragraph and line number
+        line = tuple(row[2:5])
+        if last_line is not None:
+            if line[:2] != last_line[:2]:
+                parts.append(u"\n\n")
+            elif line != last_line:
+                parts.append(u"\n")
+            else:
+                parts.append(u" ")
+        parts.append(row[11].strip())
+        last_line = line
+        if float(row[10]) >= 0:
+            confidences.append(float(row[10]))
+    text = u"".join(parts)
+    if text:
+        text += u"\n"
+    if not confidences:
+        return (text, None)
+    return (text, sum(confidences) / len(confidences))
+
+
+_ocr_service = None
+_ocr_service_pid = None
+_ocr_service_lock = threading.Lock()
+
+
+def get_ocr_service():
+    """Return the OcrService for this process. Forked processes, such as
+       extraction workers, get engines of their own.
+    """
+    global _ocr_service, _ocr_service_pid
+    with _ocr_service_lock:
+        if _ocr_service is None or _ocr_service_pid != os.getpid():
+            threads = getattr(settings, "ocr_threads", 1)
+            max_engines = getattr(settings, "ocr_engines", threads)
+            _ocr_service = OcrService(max_engines, threads, get_ocr_cache(),
+                                      imageprep.get_steps())
+            _ocr_service_pid = os.getpid()
+        return _ocr_service
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
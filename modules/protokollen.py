@@ -8,7 +8,8 @@
 
 import settings
 from modules.databases.debuggerdb import DebuggerDB
-from modules.utils import md5sum
+from modules.utils import md5sum, get_matching_prefixes
+from modules.sidecar import SIDECAR_FOLDER
 
 
 class Files(object):
@@ -30,6 +31,8 @@ class Files(object):
         except (TypeError, NameError, AttributeError):
             self.ui.info("No database setup found, using DebuggerDB")
             self.db = DebuggerDB(None, settings.db_harvest_table or "TABLE")
+        # Write all attributes of a file in one go
+        self.db = self.db.buffered()
 
         self.storage = settings.Storage(settings.access_key_id,
                                         settings.secret_access_key,
@@ -96,6 +99,38 @@ class Files(object):
             self.db.put(dbkey, u"metadata", meta.data, overwrite=overwrite)
         except Exception as e:
             self.ui.info("Could not get metadata from %s. %s" % (dbkey, e))
+        extractor.close()
+
+
+class ExtractedSnapshot(object):
+    """A snapshot of what has already been extracted, built once with a
+       few bulk requests, so that finished files can be skipped without
+       any requests per file. Contains all `file_key` values from the
+       documents database, and the folders of all documents in the
+       documents storage (one per extracted file, e.g.
+       `Ale kommun/xxx.pdf`). Page sidecars are not listed.
+    """
+
+    def __init__(self, docs_db, docs_storage):
+        self.file_keys = set(docs_db.get_next_attribute_value("file_key"))
+        keys = docs_storage.get_next_file_except(SIDECAR_FOLDER)
+        folders = set(key.name.rpartition(docs_storage.sep)[0]
+                      for key in keys)
+        self._folders = sorted(folders)
+
+    def __len__(self):
+        """len is the number of files with documents in the database"""
+        return len(self.file_keys)
+
+    def prefix_exists(self, prefix):
+        """Like Storage.prefix_exists, for the documents storage"""
+        return bool(get_matching_prefixes([prefix], self._folders))
+
+    def is_extracted(self, files_dbkey, prefix):
+        """Return True if documents from this file exist in both the
+           documents database and the documents storage.
+        """
+        return files_dbkey in self.file_keys and self.prefix_exists(prefix)
 
 if __name__ == "__main__":
     print "This module is only intended to be called from other scripts."
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""This module contains the quarantine list: files that extraction gave
+   up on, e.g. because they ran out of time or memory, with the reason.
+   extract.py skips quarantined files. To try a file again, remove its
+   line from the list.
+
+   The list is a tab separated text file, at `settings.quarantine_file`,
+   with one line per file: name, time, and reason. Lines are appended in
+   one write each, so that several processes can add to it at once.
+"""
+
+import os
+import codecs
+from datetime import datetime
+
+import settings
+
+DEFAULT_PATH = "quarantine.tsv"
+"""Default for settings.quarantine_file"""
+
+
+class Quarantine(object):
+    """A quarantine list, stored in the file `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._names = None
+
+    def get_names(self):
+        """Return the set of quarantined file names. Read once.
+        """
+        if self._names is None:
+            self._names = set()
+            if os.path.exists(self.path):
+                with codecs.open(self.path, "r", "utf-8") as file_:
+                    for line in file_:
+                        name = line.split(u"\t")[0].strip()
+                        if name:
+                            self._names.add(name)
+        return self._names
+
+    def __contains__(self, name):
+        return name in self.get_names()
+
+    def add(self, name, reason):
+        """Add the file `name` to the list.
+        """
+        # Tabs and line breaks would break the format
+        reason = u" ".join(reason.split())
+        line = u"%s\t%s\t%s\n" % (name,
+                                  datetime.now().strftime("%Y-%m-%d %H:%M"),
+                                  reason)
+        with open(self.path, "a") as file_:
+            file_.write(line.encode("utf-8"))
+        if self._names is not None:
+            self._names.add(name)
+
+
+def get_quarantine():
+    """Return the Quarantine at `settings.quarantine_file`"""
+    return Quarantine(getattr(settings, "quarantine_file", DEFAULT_PATH))
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""This module contains functions for page sidecars: a compact record of
+   the pages of an extracted file (where each page is found in the stored
+   documents, and its header and date), and of how the pages were grouped
+   into documents.
+
+   Sidecars hold no text of their own. Page text is read back from the
+   stored document text files, when needed.
+
+   Sidecars are stored as gzipped JSON in the documents storage, under
+   `SIDECAR_FOLDER`, and let `reclassify.py` regroup pages into documents
+   after a change to `settings.document_rules` or
+   `settings.document_type_settings`, without extracting the files again.
+"""
+
+import json
+import gzip
+from io import BytesIO
+from datetime import datetime
+
+from modules.utils import make_unicode
+from modules.extractors.documentBase import ExtractorBase, CachedPage
+
+SIDECAR_FOLDER = "_pages"
+"""Top level folder for sidecars in the documents storage"""
+
+VERSION = 2
+"""Sidecar format version. Version 1 sidecars held the text of the whole
+   file.
+"""
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def _date_to_string(date):
+    if date is None:
+        return None
+    return date.strftime(DATE_FORMAT)
+
+
+def _string_to_date(string):
+    if string is None:
+        return None
+    return datetime.strptime(string, DATE_FORMAT)
+
+
+def get_sidecar_name(storage, path_fragments, filename):
+    """Return the sidecar name for a file, e.g.
+       `_pages/Ale kommun/xxx.pdf/pages.gz`
+    """
+    return storage.buildRemoteName("pages",
+                                   ext="gz",
+                                   path=[SIDECAR_FOLDER] + path_fragments +
+                                   [filename])
+
+
+def get_grouping(document_list):
+    """Return a list of (document type, date, page numbers) for each
+       document in a DocumentList, in the form stored in sidecars.
+    """
+    return [[document.type_,
+             _date_to_string(document.date),
+             document.pages]
+            for document in document_list.get_next_document()]
+
+
+def build_sidecar(key, files_dbkey, document_list, stored):
+    """Return a sidecar dictionary for the file `key`, from the pages
+       and documents in `document_list`. `stored` is the set of document
+       numbers (starting from 1) whose text was stored.
+
+       Each page is stored as [page number, document number, start,
+       length, header, date, OCR resolution], where start and length
+       locate the page in the text of the stored document. Document
+       number, start and length are None for pages of documents that
+       were not stored, e.g. scanned pages that were never OCR:ed.
+
+       Page headers and dates are stored as Document saw them, i.e.
+       with the extractor's header and date filled in for pages that
+       had none of their own.
+    """
+    page_objects = dict((page.page_number, page)
+                        for (page, header, date) in document_list.pages)
+    locations = {}
+    for (i, document) in enumerate(document_list.get_next_document(), 1):
+        if i not in stored:
+            continue
+        offset = 0
+        for page_number in document.pages:
+            text = make_unicode(page_objects[page_number].get_text() or u"")
+            locations[page_number] = (i, offset, len(text))
+            offset += len(text)
+
+    pages = []
+    for (page, header, date) in document_list.pages:
+        (i, start, length) = locations.get(page.page_number,
+                                           (None, None, None))
+        pages.append([page.page_number,
+                      i,
+                      start,
+                      length,
+                      make_unicode(header) if header is not None else None,
+                      _date_to_string(date),
+                      page.ocr_resolution])
+    return {
+        "version": VERSION,
+        "file": key.name,
+        "file_key": files_dbkey,
+        "pages": pages,
+        "documents": get_grouping(document_list),
+    }
+
+
+def get_stored_documents(sidecar):
+    """Return the set of numbers of the documents that hold page text"""
+    return set(page[1] for page in sidecar["pages"] if page[1] is not None)
+
+
+def dumps(sidecar):
+    """Serialize a sidecar dictionary to gzipped JSON"""
+    buffer_ = BytesIO()
+    gzip_file = gzip.GzipFile(fileobj=buffer_, mode="wb")
+    gzip_file.write(json.dumps(sidecar, separators=(",", ":")))
+    gzip_file.close()
+    return buffer_.getvalue()
+
+
+def loads(string):
+    """Deserialize a sidecar from gzipped JSON"""
+    gzip_file = gzip.GzipFile(fileobj=BytesIO(string), mode="rb")
+    return json.loads(gzip_file.read())
+
+
+class SidecarExtractor(ExtractorBase):
+    """Yields the pages stored in a sidecar, so that they can be passed
+       to DocumentList, like pages from any other extractor.
+
+       `get_document_text(i)`, if given, should return the stored text of
+       document number `i`, as unicode. It is only called for pages whose
+       text is asked for. Without it, pages have no text.
+    """
+
+    def __init__(self, sidecar, get_document_text=None):
+        super(SidecarExtractor, self).__init__(sidecar["file"])
+        self.sidecar = sidecar
+        self.get_document_text = get_document_text
+        self._locations = dict((page[0], page[1:4])
+                               for page in sidecar["pages"])
+
+    def get_page_text(self, page_number):
+        (i, start, length) = self._locations[page_number]
+        return self.get_document_text(i)[start:start + length]
+
+    def get_next_page(self):
+        for page in self.sidecar["pages"]:
+            (page_number, i, start, length, header, date,
+             ocr_resolution) = page
+            text_loader = None
+            if i is not None and self.get_document_text is not None:
+                text_loader = self.get_page_text
+            yield CachedPage(page_number,
+                             None,
+                             header,
+                             _string_to_date(date),
+                             ocr_resolution,
+                             text_loader=text_loader)
+
+    def get_text(self):
+        return u"".join(page.get_text() or u""
+                        for page in self.get_next_page())
+
+    def get_header(self):
+        # Pages already hold the file level header, where needed
+        return ""
+
+    def get_date(self):
+        return None
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
@@ -6,6 +6,7 @@ import shutil
 from abc import ABCMeta, abstractmethod
 
 from download import FileFromS3, LocalFile, File
+from utils import get_matching_prefixes
 
 
 class Storage:
@@ -68,6 +69,15 @@ class Storage:
         """
         pass
 
+    def prefixes_exist(self, prefixes):
+        """Return the set of prefixes in `prefixes` that exist.
+
+           Should normally be overwritten by child classes, to use a more
+           efficient method.
+        """
+        return set(prefix for prefix in prefixes
+                   if self.prefix_exists(prefix))
+
     @abstractmethod
     def get_file_list_length(self, path):
         """Returns the number of files at a certain path,
@@ -90,6 +100,16 @@ class Storage:
         """
         pass
 
+    def get_next_file_except(self, folder):
+        """Like get_next_file, but skips the top level folder `folder`.
+           Backends that can skip the folder without listing it should
+           override this.
+        """
+        prefix = folder + self.sep
+        for key in self.get_next_file():
+            if not key.name.startswith(prefix):
+                yield key
+
     @abstractmethod
     def get_file(self, key, local_filename):
         """Retrieves a file identified by key, storing it locally
@@ -97,6 +117,20 @@ class Storage:
         """
         pass
 
+    @abstractmethod
+    def get_file_contents(self, filename):
+        """Returns the contents of a remote file as a string, or None
+           if the file does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def get_key(self, name):
+        """Returns a Key object, like the ones from get_next_file, from
+           its full name. Used to pass keys between processes by name.
+        """
+        pass
+
     def buildRemoteName(self,
                         name,
                         ext="",
@@ -153,11 +187,36 @@ class S3Storage(Storage):
         for k in self.connection._bucket.list(path):
             yield k
 
+    def get_next_file_except(self, folder):
+        """List top level folders first, and then each folder but `folder`.
+        """
+        import s3
+        bucket = self.connection._bucket
+        for item in bucket.list(delimiter=self.sep):
+            if item.name == folder + self.sep:
+                continue
+            if item.name.endswith(self.sep):
+                # A folder (boto Prefix)
+                for k in bucket.list(item.name):
+                    yield s3.Key(bucket, k)
+            else:
+                yield s3.Key(bucket, item)
+
     # this'll retrieve the file identified by key (returned from
     # get_next_file) and return a download.File object with .localFile
     def get_file(self, key, local_filename):
         return FileFromS3(key, local_filename)
 
+    def get_file_contents(self, filename):
+        key = self.connection._bucket.get_key(filename)
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def get_key(self, name):
+        import s3
+        return s3.Key(self.connection._bucket, name)
+
     def delete_file(self, filename):
         return self.connection.delete_key(filename)
 
@@ -167,6 +226,24 @@ class S3Storage(Storage):
         """
         return self.connection.fileExistsInBucket(fullfilename)
 
+    def prefixes_exist(self, prefixes):
+        """Check many prefixes with one bucket listing per folder,
+           rather than one per prefix.
+        """
+        folders = {}
+        for prefix in prefixes:
+            folder = prefix.rpartition(self.sep)[0]
+            folders.setdefault(folder, []).append(prefix)
+
+        found = set()
+        for folder_prefixes in folders.values():
+            common_prefix = os.path.commonprefix(folder_prefixes)
+            names = [k.name for k in
+                     self.connection._bucket.list(common_prefix)]
+            found.update(get_matching_prefixes(folder_prefixes,
+                                               sorted(names)))
+        return found
+
     def put_file(self, local_filename, s3name, headers=None):
         self.connection.put_file(local_filename, s3name, headers)
 
@@ -224,7 +301,8 @@ class LocalStorage(Storage):
         return os.path.exists(self.path + self.sep + fullfilename)
 
     def prefix_exists(self, prefix):
-        raise NotImplementedError
+        import glob
+        return len(glob.glob(self.path + self.sep + prefix + "*")) > 0
 
     def put_file(self, local_filename, remote_filename, headers=None):
         path = self.path + os.sep + remote_filename
@@ -234,7 +312,12 @@ class LocalStorage(Storage):
         shutil.copy2(local_filename, path)
 
     def get_next_file(self):
+        return self.get_next_file_except(None)
+
+    def get_next_file_except(self, folder):
         for root, dirs, files in os.walk(self.path):
+            if root == self.path and folder in dirs:
+                dirs.remove(folder)
             for f in files:
                 fullpath = root + os.sep + f
                 logicpath = fullpath[len(self.path) + 1:]
@@ -243,12 +326,30 @@ class LocalStorage(Storage):
                 yield(key)
 
     def get_next_file_by_path(self, path):
-        raise NotImplementedError
+        for root, dirs, files in os.walk(self.path + os.sep + path):
+            for f in files:
+                fullpath = root + os.sep + f
+                logicpath = fullpath[len(self.path) + 1:]
+                key = FakeKey(None, logicpath)
+                key.localFilename = fullpath
+                yield(key)
 
     def get_file(self, key, local_filename):
         # creating the LocalFile object copies the content to localFilename
         return LocalFile(key, local_filename)
 
+    def get_file_contents(self, filename):
+        try:
+            with open(self.path + os.sep + filename, "rb") as fp:
+                return fp.read()
+        except IOError:
+            return None
+
+    def get_key(self, name):
+        key = FakeKey(None, name)
+        key.localFilename = self.path + os.sep + name
+        return key
+
     def put_file_from_string(self, string, remote_filename, headers=None):
         mode = "wb" if isinstance(string, str) else "w"
         path = self.path + os.sep + remote_filename
@@ -326,6 +427,16 @@ class DropboxStorage(Storage):
             out.close()
         return File(local_filename)
 
+    def get_file_contents(self, filename):
+        try:
+            with self.connection.get_file(self.path + "/" + filename) as f:
+                return f.read()
+        except:
+            return None
+
+    def get_key(self, name):
+        return FakeKey(None, name)
+
     def prefix_exists(self, prefix):
         raise NotImplementedError
 
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""This module contains the TempSpace class, that gives each extraction
+   a private directory for temporary files. Extractors should put all
+   their temporary files in one, rather than in a shared directory, so
+   that several extractions can run side by side on the same host.
+
+   Temp spaces are created under `settings.temp_dir`, if set, or on
+   tmpfs (/dev/shm) when available.
+"""
+
+import os
+import shutil
+import tempfile
+import atexit
+
+import settings
+
+PREFIX = "protokollen-"
+"""Directory name prefix. The creating process' pid follows, so that
+   directories left behind by dead processes can be found.
+"""
+
+_open_spaces = {}
+"""Temp spaces not yet cleaned up, path => pid of the creating process"""
+
+
+def get_base_dir():
+    """Return the directory where temp spaces are created.
+    """
+    base_dir = getattr(settings, "temp_dir", None)
+    if base_dir is not None:
+        return base_dir
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _pid_is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        import errno
+        return e.errno == errno.EPERM
+    return True
+
+
+def purge_stale(base_dir=None):
+    """Remove temp spaces left behind by processes that are no longer
+       running, e.g. after a crash or a kill by the OOM killer.
+       Returns the number of directories removed.
+    """
+    base_dir = base_dir or get_base_dir()
+    if not os.path.isdir(base_dir):
+        # Not created yet, so nothing left behind
+        return 0
+    removed = 0
+    for name in os.listdir(base_dir):
+        if not name.startswith(PREFIX):
+            continue
+        try:
+            pid = int(name[len(PREFIX):].split("-")[0])
+        except ValueError:
+            continue
+        if not _pid_is_alive(pid):
+            shutil.rmtree(os.path.join(base_dir, name), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class TempSpace(object):
+    """A private directory for temporary files, removed on cleanup().
+       Can be used as a context manager:
+
+           with TempSpace() as temp_space:
+               filename = temp_space.get_path("ocr.png")
+    """
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir or get_base_dir()
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+        self.path = tempfile.mkdtemp(prefix="%s%d-" % (PREFIX, os.getpid()),
+                                     dir=self.base_dir)
+        _open_spaces[self.path] = os.getpid()
+
+    def get_path(self, filename):
+        """Return a full path for `filename` in this temp space.
+        """
+        return os.path.join(self.path, filename)
+
+    def get_dir(self, name):
+        """Return a subdirectory of this temp space, creating it if needed.
+        """
+        path = self.get_path(name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def cleanup(self):
+        """Remove the directory, and everything in it.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+        _open_spaces.pop(self.path, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.cleanup()
+
+
+@atexit.register
+def _cleanup_all():
+    """Remove any temp spaces this process forgot about.
+       Forked children inherit the list, but leave their parent's
+       directories alone.
+    """
+    pid = os.getpid()
+    for path, owner in _open_spaces.items():
+        if owner == pid:
+            shutil.rmtree(path, ignore_errors=True)
+            del _open_spaces[path]
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
@@ -99,6 +99,19 @@ def last_index(list_, value):
         return None
 
 
+def get_matching_prefixes(prefixes, sorted_names):
+    """Return the set of prefixes that any of `sorted_names` starts with.
+       `sorted_names` must be sorted.
+    """
+    from bisect import bisect_left
+    found = set()
+    for prefix in prefixes:
+        i = bisect_left(sorted_names, prefix)
+        if i < len(sorted_names) and sorted_names[i].startswith(prefix):
+            found.add(prefix)
+    return found
+
+
 def is_number(s):
     try:
         float(s)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""This module runs functions in a child process, under a budget of
+   wall clock time and memory, so that a pathological input can not
+   stall the caller:
+
+       try:
+           result = run_with_budget(function, args, timeout=600)
+       except BudgetExceeded as e:
+           print "Gave up: %s" % e
+
+   The child is put in a process group of its own, so that processes it
+   starts (e.g. Ghostscript, Tesseract, or page range workers) are
+   counted against the memory budget, and killed with it.
+
+   Memory is measured as the total resident set size (RSS) of the
+   group, from /proc. Without /proc, only the time budget applies.
+"""
+
+import os
+import signal
+import logging
+from time import time
+from multiprocessing import Process, Pipe
+
+from modules.tempspace import purge_stale
+
+POLL_INTERVAL = 1
+"""Seconds between checks of the child process"""
+
+KILL_GRACE = 5
+"""Seconds to wait for the child to exit on SIGTERM, before SIGKILL"""
+
+
+class BudgetExceeded(Exception):
+    """The child process ran out of time or memory, and was killed.
+    """
+
+
+class ChildFailed(Exception):
+    """The child process raised an exception, or died without a result.
+    """
+
+
+def get_group_rss(pgid):
+    """Return the total resident set size, in bytes, of the processes in
+       process group `pgid`, or None if /proc is not available.
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", name, "stat")) as file_:
+                stat = file_.read()
+        except IOError:
+            # Process ended
+            continue
+        # The command name, in parentheses, may contain spaces
+        fields = stat.rpartition(")")[2].split()
+        if int(fields[2]) == pgid:
+            total += int(fields[21]) * page_size
+    return total
+
+
+def _run_child(connection, function, args):
+    os.setpgrp()
+    try:
+        result = (True, function(*args))
+    except Exception as e:
+        result = (False, "%s: %s" % (type(e).__name__, e))
+    connection.send(result)
+    connection.close()
+
+
+def _kill(process):
+    """Stop the child process, and everything it started.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        # No process group yet
+        process.terminate()
+    process.join(KILL_GRACE)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        # All gone
+        pass
+    if process.is_alive():
+        os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    # Temp files of killed processes. Failing to clean up must not hide
+    # why the process was killed
+    try:
+        purge_stale()
+    except OSError as e:
+        logging.warning("Could not remove temp spaces: %s" % e)
+
+
+def run_with_budget(function, args=(), timeout=None, max_rss=None):
+    """Return `function(*args)`, run in a child process. Raises
+       BudgetExceeded if the child runs for longer than `timeout`
+       seconds, or uses more than `max_rss` bytes of memory, and
+       ChildFailed if it raises an exception or dies.
+
+       The return value is sent back through a pipe, so it must be
+       picklable.
+    """
+    (reader, writer) = Pipe(duplex=False)
+    process = Process(target=_run_child, args=(writer, function, args))
+    process.start()
+    writer.close()
+    start = time()
+    try:
+        while True:
+            if reader.poll(POLL_INTERVAL):
+                try:
+                    (success, value) = reader.recv()
+                except EOFError:
+                    # Died in the middle of sending
+                    process.join()
+                    raise ChildFailed("Process died, with exit code %s" %
+                                      process.exitcode)
+                process.join()
+                if not success:
+                    raise ChildFailed(value)
+                return value
+            if not process.is_alive() and not reader.poll(0):
+                raise ChildFailed("Process died, with exit code %s" %
+                                  process.exitcode)
+            if timeout is not None and time() - start > timeout:
+                _kill(process)
+                raise BudgetExceeded("Timed out after %d seconds" % timeout)
+            if max_rss is not None:
+                rss = get_group_rss(process.pid)
+                if rss is not None and rss > max_rss:
+                    _kill(process)
+                    raise BudgetExceeded("Used %d MB of memory, more than"
+                                         " %d MB allowed" %
+                                         (rss // 1024 ** 2,
+                                          max_rss // 1024 ** 2))
+    finally:
+        if process.is_alive():
+            # E.g. KeyboardInterrupt
+            logging.info("Stopping child process %d" % process.pid)
+            _kill(process)
+        reader.close()
+
+if __name__ == "__main__":
+    print "This module is only intended to be called from other scripts."
+    import sys
+    sys.exit()
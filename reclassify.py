@@ -0,0 +1,237 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""This script regroups the pages of already extracted files into
+   documents, after a change to `settings.document_rules` or
+   `settings.document_type_settings`. Rather than extracting the files
+   again, it uses the page sidecars stored by extract.py (see
+   modules/sidecar.py), and only updates documents whose type, date or
+   pages changed.
+
+   Files extracted before sidecars were introduced need to be extracted
+   again, with `./extract.py --overwrite`, to be reclassified.
+
+   Use `--workers N` to reclassify N files at a time, in separate
+   processes.
+"""
+
+import json
+from multiprocessing import Pool
+
+from modules.interface import Interface
+from modules.documents import DocumentList, should_store
+from modules.utils import make_unicode
+from modules import sidecar
+from extract import connect, get_document_names, store_document
+
+UNCHANGED = "unchanged"
+CHANGED = "changed"
+FAILED = "failed"
+"""Possible outcomes of reclassify_file"""
+
+
+class TextMissing(Exception):
+    """A stored document text file, needed for page text, is missing"""
+
+
+def reclassify_file(sidecar_name, ui, connections):
+    """Regroup the pages in the sidecar `sidecar_name` into documents,
+       and update the documents that changed. Returns a tuple
+       (outcome, message), where outcome is one of UNCHANGED, CHANGED
+       or FAILED.
+    """
+    (files_connection, docs_connection, files_db, docs_db) = connections
+
+    contents = docs_connection.get_file_contents(sidecar_name)
+    if contents is None:
+        return (FAILED, "Sidecar not found")
+    data = sidecar.loads(contents)
+    if data.get("version") != sidecar.VERSION:
+        return (FAILED, "Old sidecar format. Extract the file again with"
+                        " --overwrite")
+
+    key = files_connection.get_key(data["file"])
+    document_texts = {}
+
+    def get_document_text(i):
+        """Return the text of document `i`, as stored at extraction"""
+        if i not in document_texts:
+            (docs_dbkey, remote_filename) = get_document_names(key, i,
+                                                               connections)
+            text = docs_connection.get_file_contents(remote_filename)
+            if text is None:
+                raise TextMissing(remote_filename)
+            document_texts[i] = make_unicode(text)
+        return document_texts[i]
+
+    document_list = DocumentList(sidecar.SidecarExtractor(data,
+                                                          get_document_text))
+    documents = list(document_list.get_next_document())
+    # Round trip through JSON, to compare with the stored grouping
+    new_grouping = json.loads(json.dumps(sidecar.get_grouping(document_list)))
+    old_grouping = data["documents"]
+    if new_grouping == old_grouping:
+        return (UNCHANGED, "%d documents" % len(documents))
+
+    ui.info("Grouping changed for %s" % key.name)
+    if ui.executionMode >= Interface.DRY_MODE:
+        for (type_, date, pages) in new_grouping:
+            print type_, date, pages
+        return (CHANGED, "%d documents" % len(documents))
+
+    def is_changed(i):
+        return (i > len(old_grouping) or
+                old_grouping[i - 1] != new_grouping[i - 1])
+
+    # Pages of documents that were not stored at extraction have no
+    # stored text, e.g. scanned pages that were never fully OCR:ed
+    for (i, document) in enumerate(documents, 1):
+        if (is_changed(i) and should_store(document) and
+           not document.is_text_ready()):
+            return (FAILED, "Text missing for document %d. Extract the file"
+                            " again with --overwrite" % i)
+
+    # Page text is read from the documents it was stored in, so read all
+    # of it before any document is overwritten
+    old_stored = sidecar.get_stored_documents(data)
+    try:
+        for (i, document) in enumerate(documents, 1):
+            if should_store(document) and (is_changed(i) or i in old_stored):
+                document.text
+    except TextMissing as e:
+        return (FAILED, "Stored document %s is missing. Extract the file"
+                        " again with --overwrite" % e)
+
+    file_data = files_db.get_many(data["file_key"],
+                                  [u"origin", u"municipality"])
+
+    changed = 0
+    stored = set()
+    for (i, document) in enumerate(documents, 1):
+        if not is_changed(i):
+            if i in old_stored:
+                stored.add(i)
+            continue
+        changed += 1
+        if (not should_store(document) or
+           len(document.text) == 0 or document.text.isspace()):
+            # Empty documents, and documents of types not to be stored,
+            # are not stored. Remove any earlier one
+            (docs_dbkey, remote_filename) = get_document_names(key, i,
+                                                               connections)
+            docs_db.delete(docs_dbkey)
+            docs_connection.delete_file(remote_filename)
+            continue
+        store_document(key, i, document, file_data, connections,
+                       overwrite=True)
+        stored.add(i)
+
+    # Remove documents that no longer exist
+    for i in range(len(documents) + 1, len(old_grouping) + 1):
+        changed += 1
+        (docs_dbkey, remote_filename) = get_document_names(key, i,
+                                                           connections)
+        docs_db.delete(docs_dbkey)
+        docs_connection.delete_file(remote_filename)
+
+    # Pages have moved to new documents
+    data = sidecar.build_sidecar(key, data["file_key"], document_list, stored)
+    docs_connection.put_file_from_string(sidecar.dumps(data), sidecar_name)
+    return (CHANGED, "%d of %d documents updated" % (changed,
+                                                       len(documents)))
+
+
+_worker_ui = None
+_worker_connections = None
+"""Per process state, set up by _init_worker"""
+
+
+def _init_worker(ui):
+    """Runs once in each worker process, to give it connections of its own.
+    """
+    import signal
+    # Let the parent process handle Ctrl-C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    global _worker_ui, _worker_connections
+    _worker_ui = ui
+    _worker_connections = connect(ui)
+
+    # atexit handlers are not run in pool workers
+    from multiprocessing.util import Finalize
+    docs_db = _worker_connections[3]
+    Finalize(None, docs_db.close, exitpriority=10)
+
+
+def _reclassify_in_worker(sidecar_name):
+    """Reclassify a file in a worker process.
+       Returns a tuple (sidecar_name, outcome, message)
+    """
+    try:
+        (outcome, message) = reclassify_file(sidecar_name,
+                                             _worker_ui,
+                                             _worker_connections)
+    except Exception as e:
+        _worker_ui.error("Failed to reclassify %s: %s: %s" %
+                         (sidecar_name, type(e), e))
+        (outcome, message) = (FAILED, "%s: %s" % (type(e), e))
+    return (sidecar_name, outcome, message)
+
+
+def main():
+    """Entry point when run from command line"""
+
+    command_line_args = [{
+        "short": "-w",
+        "long": "--workers",
+        "dest": "workers",
+        "type": int,
+        "default": 1,
+        "help": "Number of files to reclassify in parallel."
+    }]
+    ui = Interface(__file__,
+                   "Regroups extracted pages into documents",
+                   commandline_args=command_line_args)
+
+    connections = connect(ui)
+    (files_connection, docs_connection, files_db, docs_db) = connections
+
+    sidecar_names = (k.name for k in docs_connection.get_next_file_by_path(
+        sidecar.SIDECAR_FOLDER + docs_connection.sep))
+
+    outcomes = {UNCHANGED: 0, CHANGED: 0, FAILED: 0}
+    failures = []
+    if ui.args.workers > 1:
+        ui.info("Reclassifying with %d worker processes" % ui.args.workers)
+        pool = Pool(processes=ui.args.workers,
+                    initializer=_init_worker,
+                    initargs=(ui,))
+        try:
+            for (sidecar_name, outcome, message) in pool.imap_unordered(
+                    _reclassify_in_worker, sidecar_names):
+                ui.debug("%s: %s (%s)" % (sidecar_name, outcome, message))
+                outcomes[outcome] += 1
+                if outcome == FAILED:
+                    failures.append((sidecar_name, message))
+            pool.close()
+        except KeyboardInterrupt:
+            ui.info("Interrupted, stopping workers")
+            pool.terminate()
+        pool.join()
+    else:
+        for sidecar_name in sidecar_names:
+            (outcome, message) = reclassify_file(sidecar_name, ui,
+                                                 connections)
+            ui.debug("%s: %s (%s)" % (sidecar_name, outcome, message))
+            outcomes[outcome] += 1
+            if outcome == FAILED:
+                failures.append((sidecar_name, message))
+
+    ui.info("Done. %d files changed, %d unchanged, %d failed" %
+            (outcomes[CHANGED], outcomes[UNCHANGED], outcomes[FAILED]))
+    for (sidecar_name, message) in failures:
+        ui.info("Failed: %s (%s)" % (sidecar_name, message))
+
+    ui.exit()
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,11 @@ Database = None
  To use ElasticSearch, try
      from modules.databases.elasticsearchdb import ElasticSearch
      Database = ElasticSearch
+
+ ElasticSearch needs dynamic Groovy scripting, that is disabled by
+ default from version 1.4.3. Enable it with
+     script.disable_dynamic: false
+ in elasticsearch.yml.
 """
 
 #access_key_id = None
@@ -68,6 +73,117 @@ Database = None
  Use `Database` above, to chose your preferred db.
 """
 
+#temp_dir = None
+"""
+ Where extractors put their temporary files. Each extraction gets a
+ private directory here, that is removed when it is done. Defaults to
+ /dev/shm (tmpfs), when available, or the system temp directory.
+"""
+
+#extraction_cache_dir = None
+#extraction_cache_size = 2 * 1024 ** 3
+"""
+ Directory and maximum size (in bytes) of a local cache for extracted
+ pages, keyed by file content, extractor and extractor version. When
+ set, re-extracting an unchanged file (e.g. with --overwrite) is fast.
+ Least recently used entries are removed when the cache is full.
+"""
+
+#pdf_text_engine = "pdfminer"
+"""
+ How to read text from PDF pages: "pdfminer" (layout analysis in
+ Python), or "pdftotext" (poppler's `pdftotext`, much faster). With
+ "pdftotext", pages where it fails or finds no text are read with
+ PdfMiner, and OCR:ed if needed, as usual.
+"""
+
+#pdf_streaming_min_pages = 100
+"""
+ PDF files with at least this many pages keep only the text, header and
+ date of each page once it is parsed, and release PdfMiner's layout of
+ it, so that memory use does not grow with the number of pages. Smaller
+ files keep the layout, as before. None to turn off.
+"""
+
+#pdf_range_processes = 1
+#pdf_range_min_pages = 200
+"""
+ Number of processes to analyse the pages of a large PDF file in, in
+ page ranges, each process opening the file on its own. Only files with
+ at least `pdf_range_min_pages` pages are split, so small files keep the
+ cheap path. Comes on top of `extract.py --workers`. Pages that need OCR
+ are still OCR:ed by the worker, with `ocr_threads` threads.
+"""
+
+#extraction_timeout = None
+#extraction_max_rss = None
+#extraction_max_ocr_pages = None
+"""
+ Budget for extracting a single file: wall clock time in seconds,
+ memory (resident set size, of the extraction and any processes it
+ starts) in bytes, and number of pages to OCR. With a time or memory
+ budget, each file is extracted in a child process, that is killed if
+ it overruns. Files that overrun any budget are added to the quarantine
+ list, with the reason, and skipped by later runs.
+ E.g. 1800, 4 * 1024 ** 3 and 500.
+"""
+
+#quarantine_file = "quarantine.tsv"
+"""
+ Tab separated list of files that extraction gave up on. Remove a line
+ to have the file extracted again.
+"""
+
+#ocr_cache_dir = None
+#ocr_cache_size = 2 * 1024 ** 3
+"""
+ Directory and maximum size (in bytes) of a local cache for OCR results,
+ keyed by image content. Letterheads and logos are OCR:ed once, rather
+ than once per page. Can be shared by all extraction processes on a host.
+"""
+
+#ocr_resolutions = [600]
+#ocr_min_confidence = 60
+"""
+ Resolutions, in dpi, to OCR scanned PDF pages at. Pages are first
+ OCR:ed at the lowest resolution, and rendered again at the next one
+ only if Tesseract's mean word confidence (0-100) is below
+ `ocr_min_confidence`. E.g. [300, 600] is much faster than [600] for
+ most typed minutes. The resolution used for each page is stored in
+ the page sidecars.
+
+ Confidence needs tesserocr, or a version of pytesseract with
+ `image_to_data`. Without it, pages are OCR:ed at the lowest resolution
+ only.
+"""
+
+#ocr_preprocessing = []
+#ocr_max_width = 3000
+"""
+ Steps to prepare images with before OCR, so that Tesseract has fewer
+ pixels to process. Any of "trim" (crop blank margins), "deskew",
+ "downscale" (to at most `ocr_max_width` pixels wide) and "binarize"
+ (black and white, by Otsu's method). Needs numpy. Use
+ `maintenance/benchmark_ocr.py` to compare speed and output on your own
+ files. Note that "downscale" limits the benefit of higher resolutions
+ in `ocr_resolutions`.
+"""
+
+#ocr_threads = 1
+"""
+ Number of pages to OCR at a time, within each scanned PDF file.
+ Independent of the number of files extracted at a time
+ (`extract.py --workers`), so the total can be up to workers × threads.
+"""
+
+#ocr_engines = 1
+"""
+ Number of Tesseract engines to keep loaded in each extraction process.
+ Defaults to `ocr_threads`. Only used if tesserocr is installed
+ (`pip install tesserocr`), otherwise a new tesseract process is started
+ for each image.
+"""
+
 #google_client_email = None
 #google_p12_file = None
 #google_spreadsheet_key = None
@@ -127,6 +243,15 @@ document_rules = [
  "and": [], "or": [], "not": (), "header_contains": ""
 """
 
+#stored_document_types = None
+"""
+ Document types to store, e.g. ["kommunstyrelseprotokoll", "kallelse"].
+ Documents of other types are skipped, and their scanned pages are
+ never OCR:ed beyond the header. Use None in the list for documents
+ that matched no rule. If not set, all documents are stored, and
+ scanned pages are OCR:ed as a whole right away.
+"""
+
 document_type_settings = {
     'kommunstyrelseprotokoll': {
         'disallow_infixes': True
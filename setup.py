@@ -14,11 +14,12 @@ try:
         'python-docx',  # good for text, bad for metadata
         'openxmllib',  # good for metadata, bad for text
         'pytesseract',
+#       'tesserocr',  # Keeps Tesseract loaded between images. Optional.
         'argcomplete',
         'pyOpenSSL',  # required, in practice, by oauth2client
         'boto',
         'elasticsearch',
-#       'numpy',  # for nltk. Not *actually* needed.
+#       'numpy',  # for nltk, and OCR preprocessing. Optional.
         'nltk',
         'beautifulsoup4',
         'html5lib',